@@ -3,9 +3,13 @@ Integration with Groq API for prompt analysis and enhancement.
 """
 
 import os
-import json
+import asyncio
+import hashlib
+import random
 import httpx
-from typing import Dict, Any, Tuple
+import orjson
+from cachetools import TTLCache
+from typing import Dict, Any, FrozenSet, Tuple
 from ..logging import logger, StatusMarker
 from ..models_lib import models_lib
 
@@ -15,20 +19,37 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GROQ_MODEL = "qwen-qwq-32b"
 GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
 
-async def analyze_prompt_with_groq(prompt: str) -> Tuple[str, Dict[str, Dict[str, Any]]]:
-    """
-    Use Groq's AI to analyze and enhance a prompt, identifying potential LoRAs.
-    
-    Args:
-        prompt: The user's raw text prompt
-        
-    Returns:
-        Tuple of (enhanced_prompt, additional_networks)
-            - enhanced_prompt: Improved version of the input prompt
-            - additional_networks: Dictionary of suggested LoRAs to use
-    """
-    logger.info(f"{StatusMarker.PROMPT} Analyzing prompt: '{prompt[:50]}{'...' if len(prompt) > 50 else ''}'")
-    
+# Cap simultaneous Groq calls across requests to avoid 429 cascades
+GROQ_SEM = asyncio.Semaphore(int(os.getenv("GROQ_MAX_CONCURRENCY", "8")))
+
+# Transient Groq failures are retried with exponential backoff
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRIES = 3
+MAX_RETRY_DELAY = 10.0
+
+# Shared HTTP client so Groq calls reuse pooled keep-alive connections
+_client: httpx.AsyncClient | None = None
+
+async def get_client() -> httpx.AsyncClient:
+    """Return the shared Groq HTTP client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+            timeout=httpx.Timeout(30.0),
+            http2=True
+        )
+    return _client
+
+async def close_client() -> None:
+    """Close the shared Groq HTTP client, if it was created."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def _build_system_prompt() -> str:
+    """Build the Groq system prompt from the static LoRA catalog."""
     # Prepare system message with LoRA information
     system_prompt = """
     You are an expert in analyzing and enhancing image generation prompts for Stable Diffusion.
@@ -48,16 +69,6 @@ async def analyze_prompt_with_groq(prompt: str) -> Tuple[str, Dict[str, Dict[str
     - Be specific and detailed, breaking down general concepts into specific visual elements
     - Include materials, lighting, mood, and color information when relevant
     
-    AVAILABLE LORAS:
-    """
-    
-    # Add LoRAs to the system prompt
-    for lora_name, lora_info in models_lib["loras"].items():
-        trigger_words = lora_info.get("trigger_words", [])
-        trigger_words_text = ", ".join([f'"{word}"' for word in trigger_words])
-        system_prompt += f"- {lora_name}: Best for {lora_info.get('base_model', 'any model')}. Trigger words: {trigger_words_text}\n"
-    
-    system_prompt += """
     RESPONSE FORMAT:
     You must respond in JSON format with the following structure:
     {
@@ -87,91 +98,177 @@ async def analyze_prompt_with_groq(prompt: str) -> Tuple[str, Dict[str, Dict[str
     """
     
     # Add LoRAs to the system prompt
-    available_loras = ""
-    for lora_name, lora_info in models_lib["loras"].items():
-        available_loras += f"- {lora_name}: Best for {lora_info.get('base_model', 'any model')}. Trigger words: {lora_info.get('trigger_words', [])}. Examples: {lora_info.get('examples', [])}\n"
+    available_loras = "\n".join(
+        f"- {lora_name}: Best for {lora_info.get('base_model', 'any model')}. Trigger words: {lora_info.get('trigger_words', [])}. Examples: {lora_info.get('examples', [])}"
+        for lora_name, lora_info in models_lib["loras"].items()
+    )
     system_prompt = system_prompt.replace("$LORAS", available_loras)
+    return system_prompt
+
+# models_lib is static, so the system prompt and LoRA lookups are built once at import.
+# Keeping the system message byte-identical across calls lets Groq serve it from its prompt cache.
+_SYSTEM_PROMPT: str = _build_system_prompt()
+_LORA_URN_BY_NAME: Dict[str, str] = {name: info["air"] for name, info in models_lib["loras"].items()}
+_KNOWN_LORA_NAMES: FrozenSet[str] = frozenset(_LORA_URN_BY_NAME)
+
+# Enhancement is a pure function of the prompt, so successful results are cached
+_response_cache: TTLCache = TTLCache(maxsize=2048, ttl=3600)
+_response_cache_lock = asyncio.Lock()
+
+def _retry_delay(attempt: int, retry_after: str | None = None) -> float:
+    """Seconds to wait before the next attempt, honoring a numeric Retry-After header."""
+    delay = float(2 ** attempt)
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            pass
+    return min(delay, MAX_RETRY_DELAY) + random.uniform(0, 0.5)
+
+async def _post_with_retry(client: httpx.AsyncClient, body: bytes) -> httpx.Response:
+    """
+    POST a chat completion to Groq, retrying rate limits, server errors and
+    transport failures with exponential backoff.
+    
+    Args:
+        client: The shared Groq HTTP client
+        body: Serialized JSON request body
+        
+    Returns:
+        The last response received from Groq
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with GROQ_SEM:
+                response = await client.post(
+                    GROQ_API_URL,
+                    headers={
+                        "Authorization": f"Bearer {GROQ_API_KEY}",
+                        "Content-Type": "application/json"
+                    },
+                    content=body,
+                    timeout=30.0
+                )
+        except httpx.TransportError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning("%s Groq request failed (%s), retrying in %.1fs (attempt %d/%d)", StatusMarker.MODEL, e, delay, attempt + 1, MAX_RETRIES)
+            await asyncio.sleep(delay)
+            continue
+        
+        if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+            return response
+        
+        delay = _retry_delay(attempt, response.headers.get("retry-after"))
+        logger.warning("%s Groq returned HTTP %d, retrying in %.1fs (attempt %d/%d)", StatusMarker.MODEL, response.status_code, delay, attempt + 1, MAX_RETRIES)
+        await asyncio.sleep(delay)
+
+def _cache_key(prompt: str) -> str:
+    """Normalize a prompt into a response cache key."""
+    return hashlib.blake2b(prompt.strip().lower().encode()).hexdigest()
+
+async def analyze_prompt_with_groq(prompt: str) -> Tuple[str, Dict[str, Dict[str, Any]]]:
+    """
+    Use Groq's AI to analyze and enhance a prompt, identifying potential LoRAs.
+    
+    Args:
+        prompt: The user's raw text prompt
+        
+    Returns:
+        Tuple of (enhanced_prompt, additional_networks)
+            - enhanced_prompt: Improved version of the input prompt
+            - additional_networks: Dictionary of suggested LoRAs to use
+    """
+    logger.info("%s Analyzing prompt: '%s%s'", StatusMarker.PROMPT, prompt[:50], "..." if len(prompt) > 50 else "")
+    
+    # Return a cached enhancement if this prompt was analyzed recently
+    cache_key = _cache_key(prompt)
+    async with _response_cache_lock:
+        cached = _response_cache.get(cache_key)
+    if cached is not None:
+        logger.info("%s Using cached enhancement", StatusMarker.PROMPT)
+        return cached
     
     try:
         # Call Groq API
-        logger.info(f"{StatusMarker.MODEL} Calling Groq with model: {GROQ_MODEL}")
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                GROQ_API_URL,
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": GROQ_MODEL,
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": f"Analyze and enhance this image generation prompt: '{prompt}'"}
-                    ],
-                    "max_tokens": 1024,
-                    "temperature": 0.2,
-                    "response_format": {"type": "json_object"}
-                },
-                timeout=30.0
-            )
+        logger.info("%s Calling Groq with model: %s", StatusMarker.MODEL, GROQ_MODEL)
+        client = await get_client()
+        response = await _post_with_retry(client, orjson.dumps({
+            "model": GROQ_MODEL,
+            "messages": [
+                {"role": "system", "content": _SYSTEM_PROMPT},
+                {"role": "user", "content": f"Analyze and enhance this image generation prompt: '{prompt}'"}
+            ],
+            "max_tokens": 1024,
+            "temperature": 0.2,
+            "response_format": {"type": "json_object"}
+        }))
+        
+        # Parse response
+        if response.status_code == 200:
+            result = orjson.loads(response.content)
+            content = result["choices"][0]["message"]["content"]
+            data = orjson.loads(content)
+            
+            enhanced_prompt = data.get("enhanced_prompt", prompt)
+            loras = data.get("loras", {})
             
-            # Parse response
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-                data = json.loads(content)
-                
-                enhanced_prompt = data.get("enhanced_prompt", prompt)
-                loras = data.get("loras", {})
-                
-                # Log a shorter version of the enhanced prompt
-                short_prompt = enhanced_prompt[:75] + ('...' if len(enhanced_prompt) > 75 else '')
-                logger.info(f"{StatusMarker.PROMPT} Enhanced: '{short_prompt}'")
-                
-                # Use loras directly if they're in the right format (dictionary with URNs as keys)
-                # or convert lora names to URNs if needed
-                additional_networks = {}
-                
-                if isinstance(loras, dict):
-                    for lora_key, lora_config in loras.items():
-                        # Skip if config isn't valid
-                        if not isinstance(lora_config, dict):
-                            continue
-                            
-                        # Check if the key is a valid URN or a lora name
-                        if "air:sd1:lora" in lora_key:
-                            # Already a URN, use it directly
-                            lora_urn = lora_key
-                            additional_networks[lora_urn] = {
-                                "type": lora_config.get("type", "Lora"),
-                                "strength": lora_config.get("strength", 0.75)
-                            }
-                            # Extract name from URN for logging
-                            lora_name = lora_urn.split(":")[-1].split("@")[0]
-                            logger.info(f"{StatusMarker.LORA} Added URN '{lora_name}' (strength: {lora_config.get('strength', 0.75):.2f})")
-                        elif lora_key in models_lib["loras"]:
-                            # It's a lora name, convert to URN
-                            lora_name = lora_key
-                            lora_urn = models_lib["loras"][lora_name]["air"]
-                            additional_networks[lora_urn] = {
-                                "type": lora_config.get("type", "Lora"),
-                                "strength": lora_config.get("strength", 0.75)
-                            }
-                            logger.info(f"{StatusMarker.LORA} Converted name '{lora_name}' to URN (strength: {lora_config.get('strength', 0.75):.2f})")
-                        else:
-                            # Unknown lora, log warning
-                            logger.warning(f"{StatusMarker.LORA} Unknown LoRA key: '{lora_key}', skipping")
-                
-                if not additional_networks:
-                    logger.info(f"{StatusMarker.LORA} No LoRAs selected for this prompt")
-                else:
-                    logger.info(f"{StatusMarker.LORA} Selected {len(additional_networks)} LoRA(s)")
-                
-                return enhanced_prompt, additional_networks
+            # Log a shorter version of the enhanced prompt
+            logger.info("%s Enhanced: '%s%s'", StatusMarker.PROMPT, enhanced_prompt[:75], "..." if len(enhanced_prompt) > 75 else "")
+            
+            # Report how much of the prompt prefix Groq served from its cache
+            usage = result.get("usage") or result.get("x_groq", {}).get("usage", {})
+            cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", usage.get("cached_tokens", 0))
+            logger.info("%s Groq cached prompt tokens: %s", StatusMarker.MODEL, cached_tokens)
+            
+            # Use loras directly if they're in the right format (dictionary with URNs as keys)
+            # or convert lora names to URNs if needed
+            additional_networks = {}
+            
+            if isinstance(loras, dict):
+                for lora_key, lora_config in loras.items():
+                    # Skip if config isn't valid
+                    if not isinstance(lora_config, dict):
+                        continue
+                        
+                    # Check if the key is a valid URN or a lora name
+                    if "air:sd1:lora" in lora_key:
+                        # Already a URN, use it directly
+                        lora_urn = lora_key
+                        additional_networks[lora_urn] = {
+                            "type": lora_config.get("type", "Lora"),
+                            "strength": lora_config.get("strength", 0.75)
+                        }
+                        # Extract name from URN for logging
+                        lora_name = lora_urn.split(":")[-1].split("@")[0]
+                        logger.info("%s Added URN '%s' (strength: %.2f)", StatusMarker.LORA, lora_name, lora_config.get("strength", 0.75))
+                    elif lora_key in _KNOWN_LORA_NAMES:
+                        # It's a lora name, convert to URN
+                        lora_name = lora_key
+                        lora_urn = _LORA_URN_BY_NAME[lora_name]
+                        additional_networks[lora_urn] = {
+                            "type": lora_config.get("type", "Lora"),
+                            "strength": lora_config.get("strength", 0.75)
+                        }
+                        logger.info("%s Converted name '%s' to URN (strength: %.2f)", StatusMarker.LORA, lora_name, lora_config.get("strength", 0.75))
+                    else:
+                        # Unknown lora, log warning
+                        logger.warning("%s Unknown LoRA key: '%s', skipping", StatusMarker.LORA, lora_key)
+            
+            if not additional_networks:
+                logger.info("%s No LoRAs selected for this prompt", StatusMarker.LORA)
             else:
-                logger.error(f"{StatusMarker.ERROR} Groq API error: {response.status_code}")
-                return prompt, {}  # Return original prompt and empty dict on error
-                
+                logger.info("%s Selected %d LoRA(s)", StatusMarker.LORA, len(additional_networks))
+            
+            async with _response_cache_lock:
+                _response_cache[cache_key] = (enhanced_prompt, additional_networks)
+            
+            return enhanced_prompt, additional_networks
+        else:
+            logger.error("%s Groq API error: %d", StatusMarker.ERROR, response.status_code)
+            return prompt, {}  # Return original prompt and empty dict on error
+            
     except Exception as e:
-        logger.error(f"{StatusMarker.ERROR} Prompt analysis failed: {str(e)}")
+        logger.error("%s Prompt analysis failed: %s", StatusMarker.ERROR, e)
         return prompt, {}  # Return original prompt and empty dict on error 
\ No newline at end of file
@@ -4,6 +4,15 @@ Logging configuration with custom formatter and status markers for visual feedba
 
 import logging
 
+# Emoji shown for each log level
+_LEVEL_EMOJI = {
+    'DEBUG': '🔍',
+    'INFO': '📝',
+    'WARNING': '⚠️',
+    'ERROR': '❌',
+    'CRITICAL': '🚨'
+}
+
 # Configure custom logging
 class EmojiFormatter(logging.Formatter):
     """Custom formatter that creates clean, readable logs with emojis"""
@@ -13,18 +22,16 @@ class EmojiFormatter(logging.Formatter):
         timestamp = self.formatTime(record, self.datefmt)
         
         # Determine log level emoji
-        level_emoji = {
-            'DEBUG': '🔍',
-            'INFO': '📝',
-            'WARNING': '⚠️',
-            'ERROR': '❌',
-            'CRITICAL': '🚨'
-        }.get(record.levelname, '●')
+        level_emoji = _LEVEL_EMOJI.get(record.levelname, '●')
         
         # Format message with status marker if present
         msg = record.getMessage()
         if hasattr(record, 'status_marker'):
             msg = f"{record.status_marker} {msg}"
+        
+        # Append the traceback for logger.exception() records
+        if record.exc_info:
+            msg = f"{msg}\n{self.formatException(record.exc_info)}"
             
         # Create the final formatted log
         return f"{timestamp} {level_emoji} {msg}"
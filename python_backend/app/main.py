@@ -3,9 +3,13 @@ Main application entry point for the Text to Image API.
 This file integrates the modular components and initializes the FastAPI app.
 """
 
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import httpx
 from dotenv import load_dotenv
 
 # Load environment variables first, before importing dependencies
@@ -13,6 +17,9 @@ load_dotenv()
 
 # Import logger
 from .logging import logger, StatusMarker
+from .ai.groq_integration import close_client as close_groq_client
+from .utils.output_storage import load_output_index
+from .utils.jobs_storage import load_jobs, run_jobs_flusher, close_jobs
 
 # Get Civitai API token from environment and set it directly
 CIVITAI_API_TOKEN = os.getenv("CIVITAI_API_TOKEN")
@@ -25,8 +32,37 @@ else:
 # Import civitai SDK - must be imported after setting CIVITAI_API_TOKEN
 import civitai
 
+# Log which Pillow build is in use (Pillow-SIMD versions carry a ".postN" suffix)
+import PIL
+logger.info(f"{StatusMarker.INIT} Using Pillow {PIL.__version__}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Index existing output files so image lookups skip the filesystem
+    load_output_index()
+    
+    # Compact the job log from the previous run and start flushing the new one
+    load_jobs()
+    jobs_flusher = asyncio.create_task(run_jobs_flusher())
+    
+    # One pooled client for all outbound downloads (source images, Civitai results)
+    app.state.http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64, keepalive_expiry=30),
+        timeout=httpx.Timeout(60.0),
+    )
+    yield
+    
+    # Close pooled HTTP connections
+    await app.state.http_client.aclose()
+    await close_groq_client()
+    
+    # Stop the flusher and write out any buffered job records
+    jobs_flusher.cancel()
+    close_jobs()
+
 # Create FastAPI app
-app = FastAPI(title="Text to Image API")
+app = FastAPI(title="Text to Image API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -38,7 +74,7 @@ app.add_middleware(
 )
 
 # Create directories for storing files
-os.makedirs("output", exist_ok=True)
+os.makedirs("output/.tmp", exist_ok=True)
 os.makedirs("uploads", exist_ok=True)
 os.makedirs("jobs", exist_ok=True)
 
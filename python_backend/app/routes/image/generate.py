@@ -2,8 +2,8 @@
 Endpoints for generating images from prompts.
 """
 
-import os
 import uuid
+import random
 import httpx
 import asyncio
 from fastapi import HTTPException, Request
@@ -12,11 +12,20 @@ from . import router
 from ...schemas.image_generation import CivitaiImageRequest
 from ...logging import logger, StatusMarker
 from ...utils.lora_detection import identify_loras_in_prompt
+from ...utils.civitai import CIVITAI_API_TOKEN, DEFAULT_NEGATIVE_PROMPT, generate_civitai_image
 from ...ai.groq_integration import analyze_prompt_with_groq
 from ...models_lib import models_lib
 
-# Import civitai SDK
-import civitai
+# Upper bound for per-image random seeds
+MAX_SEED = 2**32 - 1
+
+# Prompts longer than this with at least this many commas skip Groq enhancement
+DETAILED_PROMPT_MIN_LENGTH = 200
+DETAILED_PROMPT_MIN_COMMAS = 6
+
+def _is_detailed_prompt(prompt: str) -> bool:
+    """Check whether a prompt is already a detailed, comma-separated Stable Diffusion prompt."""
+    return len(prompt) > DETAILED_PROMPT_MIN_LENGTH and prompt.count(",") >= DETAILED_PROMPT_MIN_COMMAS
 
 @router.post("/generate-image")
 async def generate_image(request: CivitaiImageRequest, req: Request):
@@ -40,153 +49,111 @@ async def generate_image(request: CivitaiImageRequest, req: Request):
     try:
         # Create a job ID
         job_id = str(uuid.uuid4())
-        logger.info(f"{StatusMarker.INIT} Image generation started | Model: {request.model} | Job ID: {job_id}")
+        logger.info("%s Image generation started | Model: %s | Job ID: %s", StatusMarker.INIT, request.model, job_id)
         
         # Validate the model exists in our library
         model_name = request.model
         if model_name not in models_lib["base_models"]:
-            logger.error(f"{StatusMarker.ERROR} Model '{model_name}' not found in available models")
+            logger.error("%s Model '%s' not found in available models", StatusMarker.ERROR, model_name)
             raise HTTPException(status_code=400, detail=f"Model {model_name} not found in models library")
         
         # Get the model URN from our library (or use the one provided)
         model_urn = request.model_urn or models_lib["base_models"][model_name]["air"]
         
-        # Extract additional networks (LoRAs) if not explicitly provided
-        identified_loras = {}
+        # Extract additional networks (LoRAs) if not explicitly provided, detecting
+        # them in a worker thread while Groq enhances the prompt
         additional_networks = request.additional_networks
-        
+        original_prompt = request.prompt
+        loras_task = None
         if not additional_networks:
-            # Try to identify LoRAs from the prompt
-            identified_loras = identify_loras_in_prompt(request.prompt)
+            loras_task = asyncio.create_task(asyncio.to_thread(identify_loras_in_prompt, original_prompt))
+        
+        # Enhance the prompt using Groq, unless it is already detailed enough to use verbatim
+        prompt = original_prompt
+        groq_additional_loras = {}
+        if _is_detailed_prompt(original_prompt):
+            logger.info("%s Prompt is already detailed, skipping enhancement", StatusMarker.PROMPT)
+        else:
+            try:
+                enhanced_prompt, groq_additional_loras = await analyze_prompt_with_groq(original_prompt)
+                logger.info("%s Enhanced original prompt: '%s' to '%s...'", StatusMarker.PROMPT, original_prompt, enhanced_prompt[:100])
+                
+                # Use the enhanced prompt
+                prompt = enhanced_prompt
+            except Exception as e:
+                # Use prompt as is if enhancement fails
+                logger.error("%s Failed to enhance prompt: %s", StatusMarker.ERROR, e)
+        
+        # Prefer LoRAs identified from trigger words in the prompt
+        if loras_task is not None:
+            identified_loras = await loras_task
             if identified_loras:
-                logger.info(f"{StatusMarker.PROCESSING} Identified {len(identified_loras)} LoRAs in prompt: {', '.join(identified_loras.keys())}")
+                logger.info("%s Identified %d LoRAs in prompt: %s", StatusMarker.PROCESSING, len(identified_loras), ", ".join(identified_loras))
                 additional_networks = identified_loras
         
-        # Enhance the prompt using Groq
-        original_prompt = request.prompt
-        try:
-            enhanced_prompt, groq_additional_loras = await analyze_prompt_with_groq(original_prompt)
-            logger.info(f"{StatusMarker.PROMPT} Enhanced original prompt: '{original_prompt}' to '{enhanced_prompt[:100]}...'")
-            
-            # Use Groq's suggested LoRAs if we don't have any yet
-            if not additional_networks and groq_additional_loras:
-                logger.info(f"{StatusMarker.PROCESSING} Using {len(groq_additional_loras)} LoRAs suggested by Groq")
-                additional_networks = groq_additional_loras
-            
-            # Use the enhanced prompt
-            prompt = enhanced_prompt
-        except Exception as e:
-            logger.error(f"{StatusMarker.ERROR} Failed to enhance prompt: {str(e)}")
-            # Use prompt as is if enhancement fails
-            prompt = original_prompt
+        # Use Groq's suggested LoRAs if we don't have any yet
+        if not additional_networks and groq_additional_loras:
+            logger.info("%s Using %d LoRAs suggested by Groq", StatusMarker.PROCESSING, len(groq_additional_loras))
+            additional_networks = groq_additional_loras
         
         # Validate and limit the number of images
         num_images = min(max(request.num_images or 1, 1), 10)
-        logger.info(f"{StatusMarker.PROCESSING} Generating {num_images} images in parallel")
+        logger.info("%s Generating %d images in parallel", StatusMarker.PROCESSING, num_images)
         
         # Check if Civitai API token is available
-        CIVITAI_API_TOKEN = os.getenv("CIVITAI_API_TOKEN")
         if not CIVITAI_API_TOKEN:
-            logger.error(f"{StatusMarker.ERROR} Civitai API token is not configured")
+            logger.error("%s Civitai API token is not configured", StatusMarker.ERROR)
             raise HTTPException(status_code=500, detail="Civitai API token is not configured")
         
+        # Prepare the input for Civitai API once; only the seed varies per image
+        base_input = {
+            "model": model_urn,
+            "params": {
+                "prompt": prompt,
+                "negativePrompt": request.negative_prompt or DEFAULT_NEGATIVE_PROMPT,
+                "scheduler": "EulerA",
+                "steps": request.num_inference_steps or 30,
+                "cfgScale": request.guidance_scale or 7.5,
+                "width": request.width or 512,
+                "height": request.height or 512,
+                "clipSkip": 2
+            }
+        }
+        
+        # Add additional networks (LoRAs) if provided - at root level not in params
+        if additional_networks:
+            base_input["additionalNetworks"] = additional_networks
+        
         # Define the async function to generate a single image
-        async def generate_single_image(image_index: int, base_url: str):
+        async def generate_single_image(image_index: int, base_url: str, client: httpx.AsyncClient):
             # Create prefix for this image's logs with proper indentation
             img_prefix = f"[{image_index+1}/{num_images}]"
             
-            try:
-                logger.info(f"{StatusMarker.INIT} {img_prefix} Starting generation")
-                
-                # Prepare the input for Civitai API
-                input_data = {
-                    "model": model_urn,
-                    "params": {
-                        "prompt": prompt,
-                        "negativePrompt": request.negative_prompt or "(deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, drawing, anime, mutated hands and fingers:1.4), (deformed, distorted, disfigured:1.3)",
-                        "scheduler": "EulerA",
-                        "steps": request.num_inference_steps or 30,
-                        "cfgScale": request.guidance_scale or 7.5,
-                        "width": request.width or 512,
-                        "height": request.height or 512,
-                        "clipSkip": 2,
-                        "seed": -1  # Random seed for variety
-                    }
-                }
-                
-                # Add additional networks (LoRAs) if provided - at root level not in params
-                if additional_networks:
-                    input_data["additionalNetworks"] = additional_networks
-                
-                print("input_data", input_data)
-                logger.info(f"{StatusMarker.PROCESSING} {img_prefix} Sending to Civitai")
-                
-                # Submit the job to Civitai API
-                # Use wait=True to wait for the job to complete
-                initial_response = await civitai.image.create(input_data, wait=True)
-                
-                # Default return values
-                image_url = None
-                civitai_job_id = None
-                
-                # Since we used wait=True, the job should be complete
-                # Check if we received a successful response
-                if not initial_response or not initial_response.get('jobs'):
-                    logger.error(f"{StatusMarker.ERROR} {img_prefix} No jobs in Civitai response")
-                    return None, None
-                
-                # Get the job from the response
-                job = initial_response['jobs'][0]
-                civitai_job_id = job.get('jobId')
-                
-                # Check if the job has a result with an available blob URL
-                if job.get('result') and job['result'].get('available'):
-                    if job['result'].get('blobUrl'):
-                        image_url = job['result']['blobUrl']
-                        logger.info(f"{StatusMarker.SUCCESS} {img_prefix} Generation successful")
-                else:
-                    logger.error(f"{StatusMarker.ERROR} {img_prefix} Job completed but no image URL found")
-                    return civitai_job_id, None
-                
-                # If we got an image URL, download and save it
-                local_image_url = None
-                if image_url:
-                    logger.info(f"{StatusMarker.DOWNLOAD} {img_prefix} Downloading from Civitai")
-                    async with httpx.AsyncClient() as client:
-                        img_response = await client.get(image_url)
-                        
-                        if img_response.status_code == 200:
-                            # Save the image
-                            filename = f"civitai_{uuid.uuid4()}.png"
-                            file_path = f"output/{filename}"
-                            
-                            with open(file_path, "wb") as f:
-                                f.write(img_response.content)
-                            
-                            # Construct the full URL to the image
-                            local_image_url = f"{base_url}image/{filename}"
-                            logger.info(f"{StatusMarker.SUCCESS} {img_prefix} Saved to server")
-                        else:
-                            logger.error(f"{StatusMarker.ERROR} {img_prefix} Download failed (HTTP {img_response.status_code})")
-                
-                return civitai_job_id, local_image_url
-                
-            except Exception as e:
-                logger.error(f"{StatusMarker.ERROR} {img_prefix} Failed: {str(e)}")
-                return None, None
+            logger.info("%s %s Starting generation", StatusMarker.INIT, img_prefix)
+            
+            # Give each image its own random seed for variety
+            input_data = {**base_input, "params": {**base_input["params"], "seed": random.randint(0, MAX_SEED)}}
+            
+            logger.debug("input_data=%r", input_data)
+            return await generate_civitai_image(input_data, client, base_url, "civitai", img_prefix)
         
         # Create tasks for all images
         base_url = str(req.base_url)
-        tasks = [generate_single_image(i, base_url) for i in range(num_images)]
         
-        # Run all tasks in parallel
-        results = await asyncio.gather(*tasks)
+        # Run all tasks in parallel, sharing the app's pooled client for the downloads
+        client = req.app.state.http_client
+        tasks = [generate_single_image(i, base_url, client) for i in range(num_images)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
         
         # Process the results
         image_urls = []
         civitai_job_ids = []
         
-        for civitai_job_id, local_image_url in results:
+        for image_index, result in enumerate(results):
+            if isinstance(result, BaseException):
+                logger.error("%s [%d/%d] Failed: %s", StatusMarker.ERROR, image_index + 1, num_images, result)
+                continue
+            civitai_job_id, local_image_url = result
             if civitai_job_id:
                 civitai_job_ids.append(civitai_job_id)
             if local_image_url:
@@ -196,24 +163,27 @@ async def generate_image(request: CivitaiImageRequest, req: Request):
         if not image_urls:
             raise HTTPException(status_code=500, detail="Failed to generate any images")
         
+        # Only include optional fields when they carry data; the client falls back to its own defaults
+        generation_data = {
+            "prompt": prompt,
+            "original_prompt": original_prompt,
+            "prompt_enhanced": prompt != original_prompt,
+            "model": request.model,
+        }
+        if request.negative_prompt is not None:
+            generation_data["negative_prompt"] = request.negative_prompt
+        if additional_networks:
+            generation_data["loras"] = additional_networks
+        
         return {
             "image_urls": image_urls,
             "civitai_job_ids": civitai_job_ids,
-            "generation_data": {
-                "prompt": prompt,
-                "original_prompt": original_prompt,
-                "prompt_enhanced": prompt != original_prompt,
-                "negative_prompt": request.negative_prompt,
-                "model": request.model,
-                "loras": additional_networks
-            }
+            "generation_data": generation_data
         }
         
     except HTTPException as http_ex:
-        logger.error(f"{StatusMarker.ERROR} HTTP Exception: {http_ex.status_code} - {http_ex.detail}")
+        logger.error("%s HTTP Exception: %d - %s", StatusMarker.ERROR, http_ex.status_code, http_ex.detail)
         raise
     except Exception as e:
-        logger.error(f"{StatusMarker.ERROR} Unhandled exception: {str(e)}")
-        import traceback
-        logger.error(f"{StatusMarker.ERROR} Stack trace: {traceback.format_exc()}")
+        logger.exception("%s Unhandled exception: %s", StatusMarker.ERROR, e)
         raise HTTPException(status_code=500, detail=f"Failed to generate images: {str(e)}") 
\ No newline at end of file
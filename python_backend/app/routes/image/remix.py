@@ -2,21 +2,29 @@
 Endpoints for remixing images (generating variations).
 """
 
-import os
-import uuid
 import httpx
 import asyncio
-import base64
 from fastapi import HTTPException, Request
-from PIL import Image, ImageEnhance, ImageFilter
-import io
+from PIL import Image, ImageFilter
+import numpy as np
 import random
 
 from . import router
 from ...schemas.image_generation import RemixImageRequest
 from ...logging import logger, StatusMarker
-from ...models_lib import models_lib
 from ...ai.groq_integration import analyze_prompt_with_groq
+from ...utils.output_storage import new_output_filename, encode_image, write_output
+from ...utils.source_images import fetch_source_image
+
+# ITU-R 601 weights, matching the grayscale mean PIL's ImageEnhance.Contrast blends towards
+_LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float64)
+_LEVELS = np.arange(256, dtype=np.float64)
+
+def _mean_luma(image: Image.Image) -> float:
+    """Mean luminance of an RGB image, computed from its histogram (no pixel copies)."""
+    histogram = np.asarray(image.histogram(), dtype=np.float64).reshape(3, 256)
+    channel_means = histogram @ _LEVELS / histogram[0].sum()
+    return float(channel_means @ _LUMA_WEIGHTS)
 
 @router.post("/remix-image")
 async def remix_image(request: RemixImageRequest, req: Request):
@@ -49,7 +57,8 @@ async def remix_image(request: RemixImageRequest, req: Request):
         
         # Generate variations
         base_url = str(req.base_url)
-        image_urls = await generate_variations(request.image_url, num_images, strength, base_url)
+        client = req.app.state.http_client
+        image_urls = await generate_variations(client, request.image_url, num_images, strength, base_url)
         
         if not image_urls:
             raise HTTPException(status_code=500, detail="Failed to generate image variations")
@@ -69,16 +78,29 @@ async def remix_image(request: RemixImageRequest, req: Request):
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"{StatusMarker.ERROR} Remix error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to remix image: {str(e)}")
 
 
-async def generate_variations(image_url: str, num_images: int, strength: float, base_url: str):
+async def generate_variations(client: httpx.AsyncClient, image_url: str, num_images: int, strength: float, base_url: str):
     """Generate simple image variations using PIL."""
     
+    # Download and decode the source image once for all variations (cached across requests)
+    logger.info(f"{StatusMarker.DOWNLOAD} Fetching source image")
+    try:
+        source_image = await fetch_source_image(client, image_url)
+    except httpx.HTTPStatusError as e:
+        logger.error(f"{StatusMarker.ERROR} Download failed: HTTP {e.response.status_code}")
+        return []
+    except httpx.HTTPError as e:
+        logger.error(f"{StatusMarker.ERROR} Download failed: {str(e)}")
+        return []
+    
     # Create tasks for all image variations
-    tasks = [create_variation(image_url, i, num_images, strength, base_url) 
+    tasks = [create_variation(source_image, i, num_images, strength, base_url) 
              for i in range(num_images)]
     
     # Run all tasks in parallel and return successful results
@@ -86,53 +108,52 @@ async def generate_variations(image_url: str, num_images: int, strength: float,
     return [url for url in results if url]
 
 
-async def create_variation(image_url: str, index: int, total: int, strength: float, base_url: str):
-    """Create a single image variation."""
+def _cpu_variation(source_image: Image.Image, index: int, strength: float) -> bytes:
+    """Apply the variation effects and encode the result. Blocking; run in a worker thread."""
+    
+    # Enhancers and filters return new images, so the shared source is never modified
+    image = source_image
+    
+    # Apply effects based on strength
+    # Higher strength = more noticeable changes
+    effect_strength = strength * 1.5  # Amplify for more visible changes
+    
+    # Apply contrast and brightness as one 8-bit lookup table:
+    # contrast blends towards the mean luminance, brightness then scales the result
+    contrast = 0.8 + random.random() * effect_strength
+    brightness = 0.9 + random.random() * effect_strength
+    bias = _mean_luma(image) * (1.0 - contrast) * brightness
+    lut = np.clip(_LEVELS * (contrast * brightness) + bias, 0, 255).round().astype(np.uint8)
+    image = image.point(lut.tolist() * 3)
+    
+    # Apply blur or sharpen based on index for more variety
+    if index % 2 == 0:
+        image = image.filter(ImageFilter.GaussianBlur(radius=0.5 * effect_strength))
+    else:
+        image = image.filter(ImageFilter.SHARPEN)
+    
+    # Encode as WebP (far faster to encode and smaller than PNG for photos)
+    return encode_image(image, "WEBP", quality=88, method=4)
+
+
+async def create_variation(source_image: Image.Image, index: int, total: int, strength: float, base_url: str):
+    """Create a single image variation from the shared, already decoded source image."""
     
     img_prefix = f"[{index+1}/{total}]"
     
     try:
-        # Download source image
-        logger.info(f"{StatusMarker.PROCESSING} {img_prefix} Downloading source image")
-        async with httpx.AsyncClient() as client:
-            response = await client.get(image_url)
-            if response.status_code != 200:
-                logger.error(f"{StatusMarker.ERROR} {img_prefix} Download failed: HTTP {response.status_code}")
-                return None
-            
-            # Load and process image
-            image = Image.open(io.BytesIO(response.content))
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-                
-            # Apply effects based on strength
-            # Higher strength = more noticeable changes
-            effect_strength = strength * 1.5  # Amplify for more visible changes
-            
-            # Apply simple adjustments
-            contrast = ImageEnhance.Contrast(image)
-            image = contrast.enhance(0.8 + random.random() * effect_strength)
-            
-            brightness = ImageEnhance.Brightness(image)
-            image = brightness.enhance(0.9 + random.random() * effect_strength)
-            
-            # Apply blur or sharpen based on index for more variety
-            if index % 2 == 0:
-                image = image.filter(ImageFilter.GaussianBlur(radius=0.5 * effect_strength))
-            else:
-                image = image.filter(ImageFilter.SHARPEN)
-            
-            # Save the remixed image
-            filename = f"remix_{uuid.uuid4()}.png"
-            file_path = f"output/{filename}"
-            os.makedirs("output", exist_ok=True)
-            image.save(file_path)
-            
-            # Return URL to the image
-            image_url = f"{base_url}image/{filename}"
-            logger.info(f"{StatusMarker.SUCCESS} {img_prefix} Created variation")
-            return image_url
-            
+        # PIL releases the GIL in its C kernels, so variations run in parallel off the event loop
+        data = await asyncio.to_thread(_cpu_variation, source_image, index, strength)
+        
+        # Save the remixed image
+        filename = new_output_filename("remix", "webp")
+        await write_output(filename, data)
+        
+        # Return URL to the image
+        image_url = f"{base_url}image/{filename}"
+        logger.info(f"{StatusMarker.SUCCESS} {img_prefix} Created variation")
+        return image_url
+        
     except Exception as e:
         logger.error(f"{StatusMarker.ERROR} {img_prefix} Error: {str(e)}")
-        return None 
\ No newline at end of file
+        return None
\ No newline at end of file
@@ -2,14 +2,46 @@
 Endpoints for resizing images and creating wallpapers.
 """
 
-import os
-import uuid
+import asyncio
 from fastapi import HTTPException, Body
-from PIL import Image, ImageOps
+from PIL import Image
 from typing import Optional, Literal
 
 from . import router
 from ...logging import logger, StatusMarker
+from ...utils.output_storage import new_output_filename, save_output_image
+from ...utils.image_processing import fill_crop_box
+
+def _do_resize(image_obj: Image.Image, width: int, height: int, fit_method: str, background_color: str) -> Image.Image:
+    """Resize an image to the target dimensions using the given fit method. Blocking; no I/O."""
+    original_width, original_height = image_obj.size
+    
+    # Apply the fit method
+    if fit_method == "cover":
+        # Scale the image to cover the target dimensions, resampling only the centered
+        # region that survives the crop
+        box = fill_crop_box(image_obj.size, (width, height))
+        resized_img = image_obj.resize((width, height), Image.Resampling.LANCZOS, box=box)
+        
+    elif fit_method == "contain":
+        # Scale the image to fit within the target dimensions (may add padding)
+        ratio = min(width / original_width, height / original_height)
+        new_size = (int(original_width * ratio), int(original_height * ratio))
+        resized_img = image_obj.resize(new_size, Image.Resampling.LANCZOS)
+        
+        # Create a background image and paste the resized image in the center
+        bg_color = background_color
+        background = Image.new('RGB', (width, height), bg_color)
+        paste_x = (width - new_size[0]) // 2
+        paste_y = (height - new_size[1]) // 2
+        background.paste(resized_img, (paste_x, paste_y))
+        resized_img = background
+        
+    else:  # fit_method == "fill"
+        # Just resize to the target dimensions, ignoring aspect ratio
+        resized_img = image_obj.resize((width, height), Image.Resampling.LANCZOS)
+    
+    return resized_img
 
 @router.post("/resize-image")
 async def resize_image(
@@ -19,7 +51,7 @@ async def resize_image(
     device: Optional[str] = Body(None, description="Device type for preset dimensions"),
     maintain_aspect_ratio: bool = Body(True, description="Whether to maintain aspect ratio"),
     fit_method: Literal["cover", "contain", "fill"] = Body("contain", description="How to fit the image"),
-    output_format: Literal["png", "jpeg", "webp"] = Body("png", description="Output format"),
+    output_format: Literal["png", "jpeg", "webp"] = Body("webp", description="Output format"),
     background_color: str = Body("#000000", description="Background color for padding")
 ):
     """
@@ -88,47 +120,14 @@ async def resize_image(
             
             logger.info(f"{StatusMarker.PROCESSING} Maintaining aspect ratio, new dimensions: {width}x{height}")
         
-        # Apply the fit method
-        if fit_method == "cover":
-            # Scale the image to cover the target dimensions (may crop)
-            ratio = max(width / original_width, height / original_height)
-            new_size = (int(original_width * ratio), int(original_height * ratio))
-            resized_img = image_obj.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # Crop to fit the target dimensions
-            left = (new_size[0] - width) // 2
-            top = (new_size[1] - height) // 2
-            right = left + width
-            bottom = top + height
-            resized_img = resized_img.crop((left, top, right, bottom))
-            
-        elif fit_method == "contain":
-            # Scale the image to fit within the target dimensions (may add padding)
-            ratio = min(width / original_width, height / original_height)
-            new_size = (int(original_width * ratio), int(original_height * ratio))
-            resized_img = image_obj.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # Create a background image and paste the resized image in the center
-            bg_color = background_color
-            background = Image.new('RGB', (width, height), bg_color)
-            paste_x = (width - new_size[0]) // 2
-            paste_y = (height - new_size[1]) // 2
-            background.paste(resized_img, (paste_x, paste_y))
-            resized_img = background
-            
-        else:  # fit_method == "fill"
-            # Just resize to the target dimensions, ignoring aspect ratio
-            resized_img = image_obj.resize((width, height), Image.Resampling.LANCZOS)
+        # Resize off the event loop so concurrent requests can use multiple cores
+        resized_img = await asyncio.to_thread(_do_resize, image_obj, width, height, fit_method, background_color)
         
         # Save the resized image
-        filename = f"resized_{uuid.uuid4()}.{output_format}"
-        file_path = f"output/{filename}"
-        
-        # Ensure output directory exists
-        os.makedirs("output", exist_ok=True)
+        filename = new_output_filename("resized", output_format)
         
         # Save the image in the requested format
-        resized_img.save(file_path, format=output_format.upper())
+        await save_output_image(resized_img, filename, output_format.upper())
         
         # Construct the URL
         image_url = f"/image/{filename}"
@@ -160,7 +159,7 @@ async def create_wallpaper(
     device: str,
     image: str = Body(..., description="URL or base64 encoded image"),
     fit_method: Literal["cover", "contain", "fill"] = Body("contain", description="How to fit the image"),
-    output_format: Literal["png", "jpeg", "webp"] = Body("png", description="Output format"),
+    output_format: Literal["png", "jpeg", "webp"] = Body("webp", description="Output format"),
     background_color: str = Body("#000000", description="Background color for padding")
 ):
     """
@@ -3,16 +3,34 @@ Endpoints for retrieving generated images.
 """
 
 import os
-from fastapi import HTTPException
+from fastapi import HTTPException, Request, Response
 from fastapi.responses import FileResponse
 
 from . import router
 from ...logging import logger, StatusMarker
+from ...utils.output_storage import output_exists
+
+# Content types for the formats we write to the output directory
+MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+}
+
+# Output filenames are unique and never rewritten, so responses can be cached forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
 
 @router.get("/image/{filename}")
-async def get_image(filename: str):
+async def get_image(filename: str, request: Request):
     """Serve the generated images"""
     image_path = f"output/{filename}"
-    if not os.path.isfile(image_path):
+    if not await output_exists(filename):
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(image_path) 
\ No newline at end of file
+    
+    headers = {"Cache-Control": CACHE_CONTROL, "ETag": f'"{filename}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    
+    media_type = MEDIA_TYPES.get(os.path.splitext(filename)[1].lower())
+    return FileResponse(image_path, media_type=media_type, headers=headers) 
\ No newline at end of file
@@ -3,14 +3,54 @@ Endpoints for upscaling images using Civitai's API.
 """
 
 import os
-import uuid
-import httpx
+import asyncio
+import functools
+import numpy as np
 from fastapi import HTTPException, Body
 from PIL import Image
-from typing import Optional
+from typing import Literal, Tuple
 
 from . import router
 from ...logging import logger, StatusMarker
+from ...utils.output_storage import new_output_filename, save_output_image
+from ...utils.source_images import load_output_image
+
+# WebP can't encode images larger than this in either dimension
+WEBP_MAX_DIMENSION = 16383
+
+@functools.lru_cache(maxsize=None)
+def _cuda_available() -> bool:
+    """
+    Optional GPU resampling: used only when PyTorch with CUDA is installed.
+    torch is imported on the first upscale rather than at startup, since it is heavy.
+    """
+    try:
+        import torch
+    except ImportError:
+        return False
+    available = torch.cuda.is_available()
+    if available:
+        logger.info(f"{StatusMarker.INIT} CUDA available, upscaling on GPU")
+    return available
+
+def _cuda_resize(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Bicubic resize on the GPU (antialiased, so it is also safe for downscaling)."""
+    import torch
+    import torch.nn.functional as F
+    
+    width, height = size
+    with torch.no_grad():
+        pixels = torch.from_numpy(np.asarray(image)).cuda()
+        pixels = pixels.permute(2, 0, 1).unsqueeze(0).float().div_(255)
+        pixels = F.interpolate(pixels, size=(height, width), mode="bicubic", align_corners=False, antialias=True)
+        pixels = pixels.clamp_(0, 1).mul_(255).round_().byte().squeeze(0).permute(1, 2, 0)
+        return Image.fromarray(pixels.cpu().numpy(), mode=image.mode)
+
+def _resize(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Resize an image, on the GPU when available, otherwise with PIL's LANCZOS. Blocking."""
+    if image.mode in ("RGB", "RGBA") and _cuda_available():
+        return _cuda_resize(image, size)
+    return image.resize(size, Image.Resampling.LANCZOS)
 
 @router.post("/upscale-image/{filename}")
 async def upscale_image(
@@ -19,7 +59,8 @@ async def upscale_image(
     upscaler: str = Body("4x-UltraSharp", description="Upscaler model to use"),
     denoise_strength: float = Body(0.4, description="Denoising strength (0.0-1.0)"),
     enhance_faces: bool = Body(False, description="Enhance face detail"),
-    preserve_original_size: bool = Body(False, description="Keep original dimensions")
+    preserve_original_size: bool = Body(False, description="Keep original dimensions"),
+    output_format: Literal["png", "jpeg", "webp"] = Body("webp", description="Output format")
 ):
     """
     Upscale an image using the Civitai API.
@@ -31,19 +72,17 @@ async def upscale_image(
     - denoise_strength: Strength of denoising applied (0.0-1.0)
     - enhance_faces: Whether to enhance facial details
     - preserve_original_size: Whether to preserve the original image dimensions
+    - output_format: Output format (png, jpeg, webp)
     """
     try:
         logger.info(f"{StatusMarker.INIT} Image upscaling started | Upscaler: {upscaler}")
         
-        # Check if the file exists
-        file_path = f"output/{filename}"
-        if not os.path.exists(file_path):
-            logger.error(f"{StatusMarker.ERROR} File not found: {file_path}")
-            raise HTTPException(status_code=404, detail=f"File {filename} not found")
-        
-        # Load the image for processing
+        # Load the image for processing (decoded images are cached across requests)
         try:
-            image_obj = Image.open(file_path)
+            image_obj = await load_output_image(filename)
+        except FileNotFoundError:
+            logger.error(f"{StatusMarker.ERROR} File not found: output/{filename}")
+            raise HTTPException(status_code=404, detail=f"File {filename} not found")
         except Exception as e:
             logger.error(f"{StatusMarker.ERROR} Failed to open image: {str(e)}")
             raise HTTPException(status_code=400, detail=f"Failed to open image: {str(e)}")
@@ -93,29 +132,34 @@ async def upscale_image(
             """
             
             # Placeholder: For now, use PIL's upscaling since we don't have actual Civitai integration
-            logger.warning(f"{StatusMarker.WARNING} Civitai API integration not implemented, falling back to PIL")
+            logger.warning("Civitai API integration not implemented, falling back to PIL")
             
-            # Use PIL's resizing with Lanczos for high quality upscaling
-            upscaled_img = image_obj.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            # Resample off the event loop (GPU when available, otherwise Lanczos)
+            upscaled_img = await asyncio.to_thread(_resize, image_obj, (new_width, new_height))
             
             # If preserving original size, resize back down
             if preserve_original_size:
-                upscaled_img = upscaled_img.resize((original_width, original_height), Image.Resampling.LANCZOS)
+                upscaled_img = await asyncio.to_thread(_resize, upscaled_img, (original_width, original_height))
                 logger.info(f"{StatusMarker.PROCESSING} Preserving original size: {original_width}x{original_height}")
         else:
             # No API token - use PIL's upscaling
-            logger.warning(f"{StatusMarker.WARNING} No Civitai API token found, using PIL upscaling")
-            upscaled_img = image_obj.resize((target_width, target_height), Image.Resampling.LANCZOS)
+            logger.warning("No Civitai API token found, using PIL upscaling")
+            upscaled_img = await asyncio.to_thread(_resize, image_obj, (target_width, target_height))
         
-        # Save the upscaled image
-        upscaled_filename = f"upscaled_{uuid.uuid4()}.png"
-        upscaled_path = f"output/{upscaled_filename}"
+        # Large upscales exceed WebP's size limit; write those as PNG instead
+        if output_format == "webp" and max(upscaled_img.size) > WEBP_MAX_DIMENSION:
+            logger.info(f"{StatusMarker.PROCESSING} {upscaled_img.width}x{upscaled_img.height} is too large for WebP, saving as PNG")
+            output_format = "png"
         
-        # Ensure output directory exists
-        os.makedirs("output", exist_ok=True)
+        # Save the upscaled image
+        upscaled_filename = new_output_filename("upscaled", output_format)
         
-        # Save the image
-        upscaled_img.save(upscaled_path)
+        # Save the image in the requested format (JPEG has no alpha channel)
+        if output_format == "jpeg" and upscaled_img.mode not in ("RGB", "L"):
+            upscaled_img = upscaled_img.convert("RGB")
+        # Upscales are large; the fastest zlib level encodes PNGs several times faster
+        save_params = {"compress_level": 1} if output_format == "png" else {}
+        await save_output_image(upscaled_img, upscaled_filename, output_format.upper(), **save_params)
         
         logger.info(f"{StatusMarker.SUCCESS} Image upscaled successfully")
         
@@ -130,7 +174,8 @@ async def upscale_image(
             "original_width": original_width,
             "original_height": original_height,
             "scale_factor": scale_factor,
-            "upscaler": upscaler
+            "upscaler": upscaler,
+            "format": output_format
         }
         
     except HTTPException as http_ex:
@@ -7,28 +7,106 @@ import re
 import uuid
 import httpx
 import asyncio
-from fastapi import APIRouter, HTTPException, Request, UploadFile, File, Form, Body
+import aiofiles
+from functools import lru_cache
+from typing import Literal, Tuple
+from fastapi import APIRouter, HTTPException, Request, UploadFile, File, Form, Body, Query
 from fastapi.responses import FileResponse
 
-from ..schemas.image_generation import CivitaiImageRequest, RemixImageRequest, ResizeImageRequest
+from ..schemas.image_generation import CivitaiImageRequest, RemixImageRequest, ResizeImageRequest, FIT_METHODS
 from ..logging import logger, StatusMarker
 from ..utils.lora_detection import identify_loras_in_prompt
-from ..utils.image_processing import resize_image, DEVICE_RESOLUTIONS
+from ..utils.image_processing import resize_image, VALID_DEVICES, DEVICE_NAMES
 from ..ai.groq_integration import analyze_prompt_with_groq
 from ..models_lib import models_lib
-
-# Import civitai SDK
-import civitai
+from ..utils.output_storage import new_output_filename, write_output, output_exists
+from ..utils.civitai import CIVITAI_API_TOKEN, DEFAULT_NEGATIVE_PROMPT, generate_civitai_image
 
 router = APIRouter(tags=["image-generation"])
 
+@lru_cache(maxsize=256)
+def _hex_to_rgb(hex_color: str) -> Tuple[int, int, int]:
+    """Parse an "RRGGBB" hex color; missing trailing components default to 0."""
+    value = int(hex_color.ljust(6, "0")[:6], 16)
+    return (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF
+
+@lru_cache(maxsize=None)
+def _pyvips():
+    """
+    Optional libvips backend for upscaling: returns the pyvips module, or None when
+    pyvips or libvips isn't installed. Imported on the first upscale.
+    """
+    try:
+        import pyvips
+    except (ImportError, OSError):
+        return None
+    return pyvips
+
+# WebP can't encode images larger than this in either dimension
+_WEBP_MAX_DIMENSION = 16383
+
+def _upscale(
+    image_data: bytes, scale_factor: float, output_format: str
+) -> Tuple[bytes, str, Tuple[int, int], Tuple[int, int]]:
+    """
+    Upscale an encoded image with Lanczos resampling and encode the result. Blocking.
+
+    With libvips, decode, resize and encode run as one streaming pipeline, so the
+    full upscaled bitmap is never held in memory. Falls back to PIL when pyvips
+    is unavailable or can't decode the image.
+
+    Args:
+        image_data: The encoded source image
+        scale_factor: Factor by which to increase resolution
+        output_format: "webp" (lossy, quality 90) or "png"; upscales too large
+            for WebP are written as PNG
+
+    Returns:
+        The encoded bytes, the format actually used, the original size and the upscaled size
+    """
+    pyvips = _pyvips()
+    if pyvips is not None:
+        try:
+            source = pyvips.Image.new_from_buffer(image_data, "", access="sequential")
+            upscaled = source.resize(scale_factor, kernel="lanczos3")
+            if max(upscaled.width, upscaled.height) > _WEBP_MAX_DIMENSION:
+                output_format = "png"
+            suffix = ".webp[Q=90,effort=0]" if output_format == "webp" else ".png[compression=1]"
+            data = upscaled.write_to_buffer(suffix)
+            return data, output_format, (source.width, source.height), (upscaled.width, upscaled.height)
+        except pyvips.Error as e:
+            logger.warning(f"libvips upscale failed, falling back to PIL: {e}")
+
+    from PIL import Image
+    import io
+
+    img = Image.open(io.BytesIO(image_data))
+    original_size = img.size
+    new_size = (int(img.width * scale_factor), int(img.height * scale_factor))
+    upscaled_img = img.resize(new_size, Image.LANCZOS)
+    if max(new_size) > _WEBP_MAX_DIMENSION:
+        output_format = "png"
+    buffered = io.BytesIO()
+    if output_format == "webp":
+        upscaled_img.save(buffered, format="WEBP", quality=90, method=0)
+    else:
+        upscaled_img.save(buffered, format="PNG", compress_level=1)
+    return buffered.getvalue(), output_format, original_size, new_size
+
+# Mobile device presets always resize with the pad fit method
+_MOBILE_DEVICES = frozenset({"iphone", "iphone_plus", "iphone_se", "android"})
+
+# Detects chat response text ("I'll create an image of ...") sent in place of a prompt
+_RESPONSE_PREFILTER_RE = re.compile(r"^(?:I'll|''ll|I will) create|for you")
+# Extracts the subject from such response text
+_RESPONSE_RE = re.compile(r"(?:I'll|''ll|I will) create (?:an image|images) of (.*?)(?:\.|\sfor you)", re.IGNORECASE)
+
 @router.get("/image/{filename}")
 async def get_image(filename: str):
     """Serve the generated images"""
-    image_path = f"output/{filename}"
-    if not os.path.isfile(image_path):
+    if not await output_exists(filename):
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(image_path)
+    return FileResponse(f"output/{filename}")
 
 @router.post("/generate-image")
 async def generate_image(request: CivitaiImageRequest, req: Request):
@@ -67,11 +145,10 @@ async def generate_image(request: CivitaiImageRequest, req: Request):
         raw_prompt = request.prompt
         
         # Check if this is a response message rather than an actual prompt
-        if raw_prompt.startswith("I'll create") or raw_prompt.startswith("''ll create") or raw_prompt.startswith("I will create") or "for you" in raw_prompt:
+        if _RESPONSE_PREFILTER_RE.search(raw_prompt):
             # This is likely the response text, not the actual prompt
             # We should extract the actual subject/content from it
-            pattern = r"(?:I'll|''ll|I will) create (?:an image|images) of (.*?)(?:\.|\for you)"
-            match = re.search(pattern, raw_prompt, re.IGNORECASE)
+            match = _RESPONSE_RE.search(raw_prompt)
             if match:
                 # Extract the actual subject
                 actual_prompt = match.group(1).strip()
@@ -102,91 +179,40 @@ async def generate_image(request: CivitaiImageRequest, req: Request):
         logger.info(f"{StatusMarker.PROCESSING} Generating {num_images} images in parallel")
         
         # Check if Civitai API token is available
-        CIVITAI_API_TOKEN = os.getenv("CIVITAI_API_TOKEN")
         if not CIVITAI_API_TOKEN:
             logger.error(f"{StatusMarker.ERROR} Civitai API token is not configured")
             raise HTTPException(status_code=500, detail="Civitai API token is not configured")
         
+        # Prepare the input for Civitai API (identical for every image)
+        input_data = {
+            "model": model_urn,
+            "params": {
+                "prompt": prompt,
+                "negativePrompt": request.negative_prompt or DEFAULT_NEGATIVE_PROMPT,
+                "scheduler": "EulerA",
+                "steps": request.num_inference_steps or 30,
+                "cfgScale": request.guidance_scale or 7.5,
+                "width": request.width or 512,
+                "height": request.height or 512,
+                "clipSkip": 2,
+                "seed": -1  # Random seed for variety
+            }
+        }
+        
+        # Add additional networks (LoRAs) if provided - at root level not in params
+        if additional_networks:
+            input_data["additionalNetworks"] = additional_networks
+        logger.debug("input_data=%r", input_data)
+        
         # Define the async function to generate a single image
-        async def generate_single_image(image_index: int, base_url: str):
+        async def generate_single_image(image_index: int, base_url: str, client: httpx.AsyncClient):
             # Create prefix for this image's logs with proper indentation
             img_prefix = f"[{image_index+1}/{num_images}]"
             
             try:
                 logger.info(f"{StatusMarker.INIT} {img_prefix} Starting generation")
                 
-                # Prepare the input for Civitai API
-                input_data = {
-                    "model": model_urn,
-                    "params": {
-                        "prompt": prompt,
-                        "negativePrompt": request.negative_prompt or "(deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, drawing, anime, mutated hands and fingers:1.4), (deformed, distorted, disfigured:1.3)",
-                        "scheduler": "EulerA",
-                        "steps": request.num_inference_steps or 30,
-                        "cfgScale": request.guidance_scale or 7.5,
-                        "width": request.width or 512,
-                        "height": request.height or 512,
-                        "clipSkip": 2,
-                        "seed": -1  # Random seed for variety
-                    }
-                }
-                
-                # Add additional networks (LoRAs) if provided - at root level not in params
-                if additional_networks:
-                    input_data["additionalNetworks"] = additional_networks
-                
-                print("input_data", input_data)
-                logger.info(f"{StatusMarker.PROCESSING} {img_prefix} Sending to Civitai")
-                
-                # Submit the job to Civitai API
-                # Use wait=True to wait for the job to complete
-                initial_response = await civitai.image.create(input_data, wait=True)
-                
-                # Default return values
-                image_url = None
-                civitai_job_id = None
-                
-                # Since we used wait=True, the job should be complete
-                # Check if we received a successful response
-                if not initial_response or not initial_response.get('jobs'):
-                    logger.error(f"{StatusMarker.ERROR} {img_prefix} No jobs in Civitai response")
-                    return None, None
-                
-                # Get the job from the response
-                job = initial_response['jobs'][0]
-                civitai_job_id = job.get('jobId')
-                
-                # Check if the job has a result with an available blob URL
-                if job.get('result') and job['result'].get('available'):
-                    if job['result'].get('blobUrl'):
-                        image_url = job['result']['blobUrl']
-                        logger.info(f"{StatusMarker.SUCCESS} {img_prefix} Generation successful")
-                else:
-                    logger.error(f"{StatusMarker.ERROR} {img_prefix} Job completed but no image URL found")
-                    return civitai_job_id, None
-                
-                # If we got an image URL, download and save it
-                local_image_url = None
-                if image_url:
-                    logger.info(f"{StatusMarker.DOWNLOAD} {img_prefix} Downloading from Civitai")
-                    async with httpx.AsyncClient() as client:
-                        img_response = await client.get(image_url)
-                        
-                        if img_response.status_code == 200:
-                            # Save the image
-                            filename = f"civitai_{uuid.uuid4()}.png"
-                            file_path = f"output/{filename}"
-                            
-                            with open(file_path, "wb") as f:
-                                f.write(img_response.content)
-                            
-                            # Construct the full URL to the image
-                            local_image_url = f"{base_url}image/{filename}"
-                            logger.info(f"{StatusMarker.SUCCESS} {img_prefix} Saved to server")
-                        else:
-                            logger.error(f"{StatusMarker.ERROR} {img_prefix} Download failed (HTTP {img_response.status_code})")
-                
-                return civitai_job_id, local_image_url
+                return await generate_civitai_image(input_data, client, base_url, "civitai", img_prefix)
                 
             except Exception as e:
                 logger.error(f"{StatusMarker.ERROR} {img_prefix} Failed: {str(e)}")
@@ -194,7 +220,8 @@ async def generate_image(request: CivitaiImageRequest, req: Request):
         
         # Create tasks for all images
         base_url = str(req.base_url)
-        tasks = [generate_single_image(i, base_url) for i in range(num_images)]
+        client = req.app.state.http_client
+        tasks = [generate_single_image(i, base_url, client) for i in range(num_images)]
         
         # Run all tasks in parallel
         results = await asyncio.gather(*tasks)
@@ -274,90 +301,39 @@ async def remix_image(request: RemixImageRequest, req: Request):
         logger.info(f"{StatusMarker.PROCESSING} Generating {num_images} remix variations in parallel")
         
         # Check if Civitai API token is available
-        CIVITAI_API_TOKEN = os.getenv("CIVITAI_API_TOKEN")
         if not CIVITAI_API_TOKEN:
             logger.error(f"{StatusMarker.ERROR} Civitai API token is not configured")
             raise HTTPException(status_code=500, detail="Civitai API token is not configured")
         
+        # Prepare the input for Civitai API (identical for every image)
+        input_data = {
+            "model": model_urn,
+            "params": {
+                "prompt": prompt,
+                "negativePrompt": request.negative_prompt or DEFAULT_NEGATIVE_PROMPT,
+                "scheduler": "EulerA",
+                "steps": request.num_inference_steps or 30,
+                "cfgScale": request.guidance_scale or 7.5,
+                "width": request.width or 512,
+                "height": request.height or 512,
+                "clipSkip": 2,
+                "seed": -1  # Random seed for variety in remix
+            }
+        }
+        
+        # Add additional networks (LoRAs) if provided
+        if additional_networks:
+            input_data["additionalNetworks"] = additional_networks
+        
         # Define the async function to generate a single image (same as in generate_image)
-        async def generate_single_image(image_index: int, base_url: str):
+        async def generate_single_image(image_index: int, base_url: str, client: httpx.AsyncClient):
             # Create prefix for this image's logs with proper indentation
             img_prefix = f"[{image_index+1}/{num_images}]"
             
             try:
                 logger.info(f"{StatusMarker.INIT} {img_prefix} Starting remix variation")
                 
-                # Prepare the input for Civitai API
-                input_data = {
-                    "model": model_urn,
-                    "params": {
-                        "prompt": prompt,
-                        "negativePrompt": request.negative_prompt or "(deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, drawing, anime, mutated hands and fingers:1.4), (deformed, distorted, disfigured:1.3)",
-                        "scheduler": "EulerA",
-                        "steps": request.num_inference_steps or 30,
-                        "cfgScale": request.guidance_scale or 7.5,
-                        "width": request.width or 512,
-                        "height": request.height or 512,
-                        "clipSkip": 2,
-                        "seed": -1  # Random seed for variety in remix
-                    }
-                }
-                
-                # Add additional networks (LoRAs) if provided
-                if additional_networks:
-                    input_data["additionalNetworks"] = additional_networks
-                
-                logger.info(f"{StatusMarker.PROCESSING} {img_prefix} Sending remix to Civitai")
-                
-                # Submit the job to Civitai API
-                # Use wait=True to wait for the job to complete
-                initial_response = await civitai.image.create(input_data, wait=True)
-                
-                # Default return values
-                image_url = None
-                civitai_job_id = None
-                
-                # Since we used wait=True, the job should be complete
-                # Check if we received a successful response
-                if not initial_response or not initial_response.get('jobs'):
-                    logger.error(f"{StatusMarker.ERROR} {img_prefix} No jobs in Civitai response")
-                    return None, None
-                
-                # Get the job from the response
-                job = initial_response['jobs'][0]
-                civitai_job_id = job.get('jobId')
-                
-                # Check if the job has a result with an available blob URL
-                if job.get('result') and job['result'].get('available'):
-                    if job['result'].get('blobUrl'):
-                        image_url = job['result']['blobUrl']
-                        logger.info(f"{StatusMarker.SUCCESS} {img_prefix} Remix variation successful")
-                else:
-                    logger.error(f"{StatusMarker.ERROR} {img_prefix} Job completed but no image URL found")
-                    return civitai_job_id, None
-                
-                # If we got an image URL, download and save it
-                local_image_url = None
-                if image_url:
-                    logger.info(f"{StatusMarker.DOWNLOAD} {img_prefix} Downloading from Civitai")
-                    async with httpx.AsyncClient() as client:
-                        img_response = await client.get(image_url)
-                        
-                        if img_response.status_code == 200:
-                            # Save the image
-                            filename = f"remix_{uuid.uuid4()}.png"
-                            file_path = f"output/{filename}"
-                            
-                            with open(file_path, "wb") as f:
-                                f.write(img_response.content)
-                            
-                            # Construct the full URL to the image
-                            local_image_url = f"{base_url}image/{filename}"
-                            logger.info(f"{StatusMarker.SUCCESS} {img_prefix} Saved to server")
-                        else:
-                            logger.error(f"{StatusMarker.ERROR} {img_prefix} Download failed (HTTP {img_response.status_code})")
-                
-                return civitai_job_id, local_image_url
+                return await generate_civitai_image(input_data, client, base_url, "remix", img_prefix)
                 
             except Exception as e:
                 logger.error(f"{StatusMarker.ERROR} {img_prefix} Failed: {str(e)}")
@@ -365,7 +341,8 @@ async def remix_image(request: RemixImageRequest, req: Request):
         
         # Create tasks for all images
         base_url = str(req.base_url)
-        tasks = [generate_single_image(i, base_url) for i in range(num_images)]
+        client = req.app.state.http_client
+        tasks = [generate_single_image(i, base_url, client) for i in range(num_images)]
         
         # Run all tasks in parallel
         results = await asyncio.gather(*tasks)
@@ -439,7 +416,7 @@ async def resize_uploaded_image(
     """
     try:
         # Force pad method for mobile devices
-        if device and device.lower() in ["iphone", "iphone_plus", "iphone_se", "android"]:
+        if device and device.lower() in _MOBILE_DEVICES:
             fit_method = "pad"
             logger.info(f"{StatusMarker.PROCESSING} Forcing pad method for mobile device: {device}")
         
@@ -447,14 +424,7 @@ async def resize_uploaded_image(
         logger.info(f"{StatusMarker.INIT} Resizing image: {image.filename} with method: {fit_method}")
         
         # Convert hex background color to RGB tuple
-        bg_color = (
-            int(background_color[0:2], 16) if len(background_color) >= 2 else 0,
-            int(background_color[2:4], 16) if len(background_color) >= 4 else 0,
-            int(background_color[4:6], 16) if len(background_color) >= 6 else 0
-        )
-        
-        # Read the image data
-        image_data = await image.read()
+        bg_color = _hex_to_rgb(background_color)
         
         # Parse the request parameters
         resize_request = ResizeImageRequest(
@@ -468,7 +438,7 @@ async def resize_uploaded_image(
         
         # Perform the resize operation
         resized_data, metadata = await resize_image(
-            image_data=image_data,
+            image_data=image.file,
             width=resize_request.width,
             height=resize_request.height,
             device=resize_request.device,
@@ -480,11 +450,8 @@ async def resize_uploaded_image(
         
         # Save the resized image
         original_filename = os.path.splitext(image.filename)[0]
-        resized_filename = f"{original_filename}_resized_{uuid.uuid4()}.{resize_request.output_format.lower()}"
-        resized_filepath = f"output/{resized_filename}"
-        
-        with open(resized_filepath, "wb") as f:
-            f.write(resized_data)
+        resized_filename = new_output_filename(f"{original_filename}_resized", resize_request.output_format.lower())
+        await write_output(resized_filename, resized_data)
         
         logger.info(f"{StatusMarker.SUCCESS} Image resized: {resized_filename}")
         
@@ -537,30 +504,22 @@ async def create_wallpaper(
         
         # Check if the device is supported
         device = device.lower()
-        if device not in DEVICE_RESOLUTIONS:
-            valid_devices = ", ".join(DEVICE_RESOLUTIONS.keys())
+        if device not in VALID_DEVICES:
             raise HTTPException(
                 status_code=400, 
-                detail=f"Unknown device '{device}'. Available devices: {valid_devices}"
+                detail=f"Unknown device '{device}'. Available devices: {DEVICE_NAMES}"
             )
             
         # Convert hex background color to RGB tuple
-        bg_color = (
-            int(background_color[0:2], 16) if len(background_color) >= 2 else 0,
-            int(background_color[2:4], 16) if len(background_color) >= 4 else 0,
-            int(background_color[4:6], 16) if len(background_color) >= 6 else 0
-        )
-            
-        # Read the image data
-        image_data = await image.read()
+        bg_color = _hex_to_rgb(background_color)
         
         # Validate fit method
-        if fit_method not in ["fill", "pad", "fit", "stretch"]:
+        if fit_method not in FIT_METHODS:
             fit_method = "fill"  # Use fill as fallback
         
         # Perform the resize operation
         resized_data, metadata = await resize_image(
-            image_data=image_data,
+            image_data=image.file,
             device=device,
             maintain_aspect_ratio=True,
             fit_method=fit_method,
@@ -570,11 +529,8 @@ async def create_wallpaper(
         
         # Save the resized image
         original_filename = os.path.splitext(image.filename)[0]
-        resized_filename = f"{original_filename}_wallpaper_{device}_{uuid.uuid4()}.{output_format.lower()}"
-        resized_filepath = f"output/{resized_filename}"
-        
-        with open(resized_filepath, "wb") as f:
-            f.write(resized_data)
+        resized_filename = new_output_filename(f"{original_filename}_wallpaper_{device}", output_format.lower())
+        await write_output(resized_filename, resized_data)
         
         logger.info(f"{StatusMarker.SUCCESS} Wallpaper created: {resized_filename}")
         
@@ -603,7 +559,8 @@ async def upscale_image(
     upscaler: str = Body("4x-UltraSharp", description="Upscaler model to use"),
     denoise_strength: float = Body(0.4, description="Denoising strength (0.0-1.0)"),
     enhance_faces: bool = Body(False, description="Enhance face detail"),
-    preserve_original_size: bool = Body(False, description="Keep original dimensions")
+    preserve_original_size: bool = Body(False, description="Keep original dimensions"),
+    output_format: Literal["webp", "png"] = Query("webp", alias="format", description="Output format")
 ):
     """
     Upscale an image to increase its resolution using Civitai API.
@@ -615,6 +572,7 @@ async def upscale_image(
     - denoise_strength: Strength of denoising during upscale (default: 0.4)
     - enhance_faces: Whether to use face enhancement (default: False)
     - preserve_original_size: Keep original dimensions (default: False)
+    - format: Output format, "webp" or "png" (query parameter, default: webp)
     
     Returns:
     - URL to the upscaled image and metadata
@@ -632,17 +590,9 @@ async def upscale_image(
             )
             
         # Read the image data
-        with open(file_path, "rb") as f:
-            image_data = f.read()
+        async with aiofiles.open(file_path, "rb") as f:
+            image_data = await f.read()
             
-        # Load the image
-        from PIL import Image
-        import io
-        import base64
-        
-        img = Image.open(io.BytesIO(image_data))
-        original_width, original_height = img.size
-        
         # For this demo, we'll use the PIL upscaler as we don't have Civitai API credentials
         # In a real implementation, you would send this to Civitai API
         
@@ -678,26 +628,17 @@ async def upscale_image(
         '''
         
         # For now, use a local implementation
-        # Calculate new dimensions
-        new_width = int(original_width * scale_factor)
-        new_height = int(original_height * scale_factor)
-        
         # Use Lanczos resampling for high-quality upscaling
-        upscaled_img = img.resize((new_width, new_height), Image.LANCZOS)
+        upscaled_data, output_format, (original_width, original_height), (new_width, new_height) = await asyncio.to_thread(
+            _upscale, image_data, scale_factor, output_format
+        )
         
         # Save the upscaled image
         original_filename = os.path.splitext(filename)[0]
-        upscaled_filename = f"{original_filename}_upscaled_{uuid.uuid4()}.png"
-        upscaled_filepath = f"output/{upscaled_filename}"
-        
-        # Convert to bytes
-        buffered = io.BytesIO()
-        upscaled_img.save(buffered, format="PNG")
-        upscaled_data = buffered.getvalue()
+        upscaled_filename = new_output_filename(f"{original_filename}_upscaled", output_format)
         
         # Save the file
-        with open(upscaled_filepath, "wb") as f:
-            f.write(upscaled_data)
+        await write_output(upscaled_filename, upscaled_data)
         
         logger.info(f"{StatusMarker.SUCCESS} Image upscaled: {upscaled_filename}")
         
@@ -712,7 +653,7 @@ async def upscale_image(
                 "upscaler": upscaler,
                 "denoise_strength": denoise_strength,
                 "enhance_faces": enhance_faces,
-                "output_format": "PNG",
+                "output_format": output_format.upper(),
                 "file_size_bytes": len(upscaled_data)
             }
         }
@@ -2,17 +2,19 @@
 API endpoints for text interpretation.
 """
 
-import json
-import httpx
+import orjson
 from fastapi import APIRouter, HTTPException, Form
 from typing import Dict
 
 from ..logging import logger, StatusMarker
-from ..ai.groq_integration import GROQ_API_KEY, GROQ_MODEL, GROQ_API_URL
+from ..ai.groq_integration import GROQ_API_KEY, GROQ_MODEL, GROQ_API_URL, get_client
 from ..schemas.interpretation import InterpretResponse
 
 router = APIRouter(tags=["interpretation"])
 
+# Chat role for a history message, indexed by its isUser flag
+ROLE = ("assistant", "user")
+
 @router.post("/interpret", response_model=InterpretResponse)
 async def interpret_text(text: str = Form(...), history: str = Form(None)) -> Dict[str, str]:
     """
@@ -23,14 +25,12 @@ async def interpret_text(text: str = Form(...), history: str = Form(None)) -> Di
         messages = []
         if history:
             try:
-                history_data = json.loads(history)
+                history_data = orjson.loads(history)
                 messages = [
-                    {"role": "assistant" if not msg["isUser"] else "user", 
-                     "content": msg["content"]} 
+                    {"role": ROLE[bool(msg.get("isUser"))], "content": msg["content"]}
                     for msg in history_data
                 ]
-                print('messages', messages)
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 logger.warning("Failed to parse message history")
         
         # Create a system prompt for Groq
@@ -52,41 +52,32 @@ async def interpret_text(text: str = Form(...), history: str = Form(None)) -> Di
         all_messages.extend(messages)
         all_messages.append({"role": "user", "content": text})
         
-        # Call Groq API
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                GROQ_API_URL,
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": GROQ_MODEL,
-                    "messages": all_messages,
-                    "max_tokens": 1500,
-                    "temperature": 0.7,
-                    "response_format": {"type": "json_object"}
-                },
-                timeout=30.0
-            )
-            
-            print(response.status_code, response)
-
-            if response.status_code != 200:
-                print(response.text)
-                raise HTTPException(status_code=500, detail="Failed to get response from Groq API")
-            
-            # Parse the response
-            result = response.json()
-            content = result["choices"][0]["message"]["content"]
-            
-            # If content is already a dict, use it directly
-            if isinstance(content, dict):
-                return content
-            
-            # Otherwise parse the JSON string
-            return json.loads(content)
-            
+        # Call Groq API over the shared, pooled client
+        client = await get_client()
+        response = await client.post(
+            GROQ_API_URL,
+            headers={
+                "Authorization": f"Bearer {GROQ_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            content=orjson.dumps({
+                "model": GROQ_MODEL,
+                "messages": all_messages,
+                "max_tokens": 1500,
+                "temperature": 0.7,
+                "response_format": {"type": "json_object"}
+            }),
+            timeout=30.0
+        )
+        
+        if response.status_code != 200:
+            logger.error(f"{StatusMarker.ERROR} Groq API returned {response.status_code}: {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to get response from Groq API")
+        
+        # Parse the response; with JSON mode the message content is always a JSON string
+        result = orjson.loads(response.content)
+        return orjson.loads(result["choices"][0]["message"]["content"])
+        
     except Exception as e:
         logger.error(f"{StatusMarker.ERROR} Failed to process request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to process request: {str(e)}") 
\ No newline at end of file
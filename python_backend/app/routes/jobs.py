@@ -2,7 +2,8 @@
 API endpoints for job tracking and management.
 """
 
-from fastapi import APIRouter, HTTPException
+import hashlib
+from fastapi import APIRouter, HTTPException, Request, Response
 
 from ..schemas.jobs import JobStatus
 from ..logging import logger, StatusMarker
@@ -10,15 +11,25 @@ from ..utils.jobs_storage import get_job
 
 router = APIRouter(tags=["jobs"])
 
+# Job status changes over time, so clients must revalidate, but unchanged polls get a bodiless 304
+CACHE_CONTROL = "no-cache"
+
 @router.get("/jobs/{job_id}", response_model=JobStatus)
-async def get_job_status(job_id: str):
+async def get_job_status(job_id: str, request: Request, response: Response):
     """Get the status of a specific job"""
     try:
         job_data = get_job(job_id)
         
         if not job_data:
             raise HTTPException(status_code=404, detail="Job not found")
-            
+        
+        # Every update bumps updated_at, so it identifies the job's current state
+        etag = f'"{hashlib.blake2b(job_data["updated_at"].encode(), digest_size=8).hexdigest()}"'
+        headers = {"Cache-Control": CACHE_CONTROL, "ETag": etag}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        
+        response.headers.update(headers)
         return job_data
     except HTTPException:
         raise
@@ -2,7 +2,7 @@
 Schemas for image generation requests and responses.
 """
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, field_validator
 from typing import Optional, Dict, Any, List
 
 class TextToImageRequest(BaseModel):
@@ -30,7 +30,8 @@ class CivitaiImageRequest(BaseModel):
     additional_networks: Optional[Dict[str, Dict[str, Any]]] = None  # Dictionary of LoRA configurations
 
     # Add validator to ensure num_images is between 1 and 10
-    @validator('num_images')
+    @field_validator('num_images')
+    @classmethod
     def validate_num_images(cls, v):
         if v is not None and (v < 1 or v > 10):
             raise ValueError('num_images must be between 1 and 10')
@@ -51,6 +52,11 @@ class RemixImageRequest(BaseModel):
     guidance_scale: Optional[float] = 7.5 
     strength: Optional[float] = 0.7  # How much to modify the image (0.0-1.0)
 
+# Accepted values for ResizeImageRequest, checked on every request
+_OUTPUT_FORMATS = frozenset({"PNG", "JPEG", "JPG", "GIF", "BMP", "WEBP"})
+# Also used by the wallpaper endpoint, which takes the fit method as a form field
+FIT_METHODS = frozenset({"fit", "fill", "stretch", "pad"})
+
 class ResizeImageRequest(BaseModel):
     """Request model for resizing an uploaded image."""
     width: Optional[int] = None
@@ -60,14 +66,16 @@ class ResizeImageRequest(BaseModel):
     fit_method: str = "fit"
     output_format: str = "PNG"
 
-    @validator('output_format')
+    @field_validator('output_format')
+    @classmethod
     def validate_output_format(cls, v):
-        if v not in ["PNG", "JPEG", "JPG", "GIF", "BMP", "WEBP"]:
+        if v not in _OUTPUT_FORMATS:
             raise ValueError('output_format must be a valid image format (PNG, JPEG, JPG, GIF, BMP, WEBP)')
         return v.upper()
         
-    @validator('fit_method')
+    @field_validator('fit_method')
+    @classmethod
     def validate_fit_method(cls, v):
-        if v not in ["fit", "fill", "stretch", "pad"]:
+        if v not in FIT_METHODS:
             raise ValueError('fit_method must be one of: fit, fill, stretch, pad')
         return v.lower() 
\ No newline at end of file
@@ -4,6 +4,16 @@ Utility functions for the application.
 
 from .image_processing import process_images
 from .lora_detection import identify_loras_in_prompt
+from .output_storage import (
+    new_output_filename,
+    encode_image,
+    write_output,
+    write_output_stream,
+    save_output_image,
+    register_output,
+    output_exists,
+)
+from .source_images import fetch_source_image, load_output_image
 from .jobs_storage import (
     jobs, 
     get_job, 
@@ -15,6 +25,15 @@ from .jobs_storage import (
 __all__ = [
     "process_images",
     "identify_loras_in_prompt",
+    "new_output_filename",
+    "encode_image",
+    "write_output",
+    "write_output_stream",
+    "save_output_image",
+    "register_output",
+    "output_exists",
+    "fetch_source_image",
+    "load_output_image",
     "jobs",
     "get_job",
     "create_job",
@@ -0,0 +1,91 @@
+"""
+Shared Civitai configuration and job handling for the image generation routes.
+"""
+
+import os
+import asyncio
+import httpx
+from typing import Any, Dict, Optional, Tuple
+
+from ..logging import logger, StatusMarker
+from .output_storage import new_output_filename, write_output_stream
+
+# Import civitai SDK
+import civitai
+
+# Civitai API token, read once at import (main.py loads .env before the routes)
+CIVITAI_API_TOKEN = os.getenv("CIVITAI_API_TOKEN")
+
+# Used when the request does not provide a negative prompt
+DEFAULT_NEGATIVE_PROMPT = "(deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, drawing, anime, mutated hands and fingers:1.4), (deformed, distorted, disfigured:1.3)"
+
+# Cap simultaneous Civitai submissions across requests to avoid rate limiting
+CIVITAI_SEM = asyncio.Semaphore(int(os.getenv("CIVITAI_MAX_CONCURRENCY", "16")))
+
+async def generate_civitai_image(
+    input_data: Dict[str, Any],
+    client: httpx.AsyncClient,
+    base_url: str,
+    filename_prefix: str,
+    img_prefix: str,
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Submit one Civitai generation job, wait for it, and save the result to the output directory.
+    
+    Args:
+        input_data: The Civitai job input (model, params, additional networks)
+        client: Shared HTTP client used for the download
+        base_url: Base URL of this server, used to build the local image URL
+        filename_prefix: Prefix for the output filename
+        img_prefix: Log prefix identifying the image, e.g. "[1/4]"
+    
+    Returns:
+        (civitai_job_id, local_image_url); either may be None on failure
+    """
+    logger.info("%s %s Sending to Civitai", StatusMarker.PROCESSING, img_prefix)
+    
+    # Submit the job to Civitai API
+    # Use wait=True to wait for the job to complete
+    async with CIVITAI_SEM:
+        initial_response = await civitai.image.create(input_data, wait=True)
+    
+    # Default return values
+    image_url = None
+    civitai_job_id = None
+    
+    # Since we used wait=True, the job should be complete
+    # Check if we received a successful response
+    if not initial_response or not initial_response.get('jobs'):
+        logger.error("%s %s No jobs in Civitai response", StatusMarker.ERROR, img_prefix)
+        return None, None
+    
+    # Get the job from the response
+    job = initial_response['jobs'][0]
+    civitai_job_id = job.get('jobId')
+    
+    # Check if the job has a result with an available blob URL
+    if job.get('result') and job['result'].get('available'):
+        if job['result'].get('blobUrl'):
+            image_url = job['result']['blobUrl']
+            logger.info("%s %s Generation successful", StatusMarker.SUCCESS, img_prefix)
+    else:
+        logger.error("%s %s Job completed but no image URL found", StatusMarker.ERROR, img_prefix)
+        return civitai_job_id, None
+    
+    # If we got an image URL, download and save it
+    local_image_url = None
+    if image_url:
+        logger.info("%s %s Downloading from Civitai", StatusMarker.DOWNLOAD, img_prefix)
+        async with client.stream("GET", image_url) as img_response:
+            if img_response.status_code == 200:
+                # Stream the image to a temp file, renamed into place once complete
+                filename = new_output_filename(filename_prefix, "png")
+                await write_output_stream(filename, img_response.aiter_bytes(65536))
+                
+                # Construct the full URL to the image
+                local_image_url = f"{base_url}image/{filename}"
+                logger.info("%s %s Saved to server", StatusMarker.SUCCESS, img_prefix)
+            else:
+                logger.error("%s %s Download failed (HTTP %d)", StatusMarker.ERROR, img_prefix, img_response.status_code)
+    
+    return civitai_job_id, local_image_url
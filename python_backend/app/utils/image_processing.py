@@ -4,10 +4,14 @@ Utility functions for processing images.
 
 import io
 import uuid
-import base64
-from typing import List, Dict, Any, Optional, Tuple
+import asyncio
+import hashlib
+import aiofiles
+from binascii import b2a_base64
+from typing import List, Dict, Any, Optional, Tuple, Union, BinaryIO
 from fastapi import HTTPException, UploadFile
 from PIL import Image
+from cachetools import LRUCache
 
 # Dictionary of common device resolutions
 DEVICE_RESOLUTIONS = {
@@ -23,6 +27,87 @@ DEVICE_RESOLUTIONS = {
     "android": (1080, 2400),  # Common Android resolution
 }
 
+# Device names for membership checks and error messages, computed once
+VALID_DEVICES = frozenset(DEVICE_RESOLUTIONS)
+DEVICE_NAMES = ", ".join(DEVICE_RESOLUTIONS)
+
+def fill_crop_box(source_size: Tuple[int, int], target_size: Tuple[int, int]) -> Tuple[float, float, float, float]:
+    """
+    Return the centered source region with the target's aspect ratio.
+
+    Passed as Image.resize(box=...), this scales and crops in a single pass: only the
+    pixels that end up in the output are resampled, with no full-size intermediate.
+    """
+    source_width, source_height = source_size
+    target_width, target_height = target_size
+    scale = max(target_width / source_width, target_height / source_height)
+    crop_width = target_width / scale
+    crop_height = target_height / scale
+    left = (source_width - crop_width) / 2
+    top = (source_height - crop_height) / 2
+    return (left, top, left + crop_width, top + crop_height)
+
+# Base64 input block size; a multiple of 3 so blocks encode without padding
+_B64_BLOCK = 57 * 1024
+
+def _b64encode_buffer(buffer: io.BytesIO) -> str:
+    """Base64-encode a buffer's contents block by block into a single output buffer."""
+    encoded = bytearray()
+    with buffer.getbuffer() as view:
+        for start in range(0, len(view), _B64_BLOCK):
+            encoded += b2a_base64(view[start:start + _B64_BLOCK], newline=False)
+    return encoded.decode("ascii")
+
+# Thumbnails sent to the API are bounded to this size
+THUMBNAIL_SIZE = (512, 512)
+
+# Uploads are streamed to disk in chunks of this size rather than read into memory
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Base64 thumbnails keyed by a hash of the uploaded bytes, so re-uploads of the same
+# file (e.g. a retried request) skip the decode, resize and encode. Bounded by total size.
+THUMBNAIL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_thumbnail_cache: LRUCache = LRUCache(maxsize=THUMBNAIL_CACHE_MAX_BYTES, getsizeof=len)
+
+async def _save_upload(upload: UploadFile, filepath: str) -> bytes:
+    """
+    Stream an upload to disk chunk by chunk, hashing it on the way.
+
+    Returns:
+        The blake2b digest of the file contents
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    async with aiofiles.open(filepath, "wb") as f:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            await f.write(chunk)
+    return digest.digest()
+
+def _encode_thumbnail(filepath: str) -> str:
+    """Decode an image file and return its thumbnail as base64 PNG. Blocking."""
+    with Image.open(filepath) as image:
+        # Resize for API consumption
+        image.thumbnail(THUMBNAIL_SIZE)
+        buffered = io.BytesIO()
+        # Fastest zlib level: the thumbnail is a transient API payload, so speed beats size
+        image.save(buffered, format="PNG", compress_level=1)
+    return _b64encode_buffer(buffered)
+
+async def _thumbnail_b64(key: bytes, filepath: str) -> str:
+    """Return the base64 PNG thumbnail of a saved upload, reusing a cached copy for the same content hash."""
+    img_base64 = _thumbnail_cache.get(key)
+    if img_base64 is not None:
+        return img_base64
+    
+    # The cache is only touched on the event loop; the PIL work runs in a worker thread
+    img_base64 = await asyncio.to_thread(_encode_thumbnail, filepath)
+    if len(img_base64) <= THUMBNAIL_CACHE_MAX_BYTES:
+        _thumbnail_cache[key] = img_base64
+    return img_base64
+
 async def process_images(images: List[UploadFile]) -> List[Dict[str, Any]]:
     """
     Process uploaded images, save them to disk, and prepare for API consumption.
@@ -39,24 +124,15 @@ async def process_images(images: List[UploadFile]) -> List[Dict[str, Any]]:
     processed_images = []
     
     for idx, img in enumerate(images):
-        # Read image content
-        content = await img.read()
-        
         # Save image to uploads folder
         filename = f"upload_{uuid.uuid4()}.png"
         filepath = f"uploads/{filename}"
         
-        with open(filepath, "wb") as f:
-            f.write(content)
+        content_hash = await _save_upload(img, filepath)
         
         # Create thumbnail and base64 encode for API
         try:
-            image = Image.open(io.BytesIO(content))
-            # Resize for API consumption
-            image.thumbnail((512, 512))
-            buffered = io.BytesIO()
-            image.save(buffered, format="PNG")
-            img_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+            img_base64 = await _thumbnail_b64(content_hash, filepath)
             
             processed_images.append({
                 "index": idx,
@@ -70,8 +146,146 @@ async def process_images(images: List[UploadFile]) -> List[Dict[str, Any]]:
     
     return processed_images
 
+def _resize_image(
+    image_data: Union[bytes, BinaryIO], 
+    width: Optional[int] = None, 
+    height: Optional[int] = None, 
+    device: Optional[str] = None,
+    maintain_aspect_ratio: bool = True,
+    fit_method: str = "fit",
+    output_format: str = "PNG",
+    background_color: tuple = (0, 0, 0)  # Default black background for padding
+) -> Tuple[bytes, Dict[str, Any]]:
+    """Decode, resize and encode an image. Blocking; see resize_image."""
+    # Load the image
+    img = Image.open(io.BytesIO(image_data) if isinstance(image_data, bytes) else image_data)
+    original_format = img.format or "PNG"
+    original_size = (img.width, img.height)
+    original_ratio = original_size[0] / original_size[1]
+    
+    # Determine target dimensions
+    target_width, target_height = width, height
+    
+    # Use device preset if specified
+    if device:
+        device = device.lower()
+        if device in VALID_DEVICES:
+            target_width, target_height = DEVICE_RESOLUTIONS[device]
+        else:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Unknown device '{device}'. Available devices: {DEVICE_NAMES}"
+            )
+    
+    # Validate dimensions
+    if not (target_width or target_height):
+        raise HTTPException(
+            status_code=400, 
+            detail="Either width, height, or device must be specified"
+        )
+    
+    # For JPEG sources, let libjpeg decode at 1/2, 1/4 or 1/8 scale when heavily downsizing,
+    # keeping 2x headroom so the final quality still comes from LANCZOS. "fill" is skipped: its
+    # crop box may cover a small part of the source, which needs full-resolution pixels.
+    # original_size keeps reporting the true size; resampling below only uses the aspect
+    # ratio and target sizes, which the reduced decode doesn't change.
+    if img.format == "JPEG" and fit_method != "fill":
+        draft_width = target_width or int(target_height * original_ratio)
+        draft_height = target_height or int(target_width / original_ratio)
+        img.draft("RGB", (draft_width * 2, draft_height * 2))
+    
+    # Handle different fit methods
+    if fit_method == "stretch" or not maintain_aspect_ratio:
+        # Just force the dimensions, potentially distorting the image
+        if not target_width:
+            target_width = int(target_height * original_ratio)
+        if not target_height:
+            target_height = int(target_width / original_ratio)
+    
+        resized_img = img.resize((target_width, target_height), Image.LANCZOS)
+    
+    elif fit_method == "fill":
+        # Scale and crop to fill the target dimensions
+        if not target_width:
+            target_width = int(target_height * original_ratio)
+        if not target_height:
+            target_height = int(target_width / original_ratio)
+    
+        # Resample only the centered region that fills the target (scale and crop in one pass)
+        box = fill_crop_box(img.size, (target_width, target_height))
+        resized_img = img.resize((target_width, target_height), Image.LANCZOS, box=box)
+    
+    elif fit_method == "pad":
+        # Ensure entire image is visible within target dimensions by adding padding
+        if not target_width:
+            target_width = int(target_height * original_ratio)
+        if not target_height:
+            target_height = int(target_width / original_ratio)
+    
+        # Calculate the scaling factor to fit within the target dimensions
+        target_ratio = target_width / target_height
+    
+        if original_ratio > target_ratio:  # Image is wider than target
+            # Scale by width
+            new_width = target_width
+            new_height = int(new_width / original_ratio)
+        else:  # Image is taller than target
+            # Scale by height
+            new_height = target_height
+            new_width = int(new_height * original_ratio)
+    
+        # Resize the image to fit within target dimensions
+        resized = img.resize((new_width, new_height), Image.LANCZOS)
+    
+        # Create a new image with the target dimensions and the specified background color
+        resized_img = Image.new("RGB", (target_width, target_height), background_color)
+    
+        # Calculate position to paste (center the image)
+        paste_x = (target_width - new_width) // 2
+        paste_y = (target_height - new_height) // 2
+    
+        # Paste the resized image onto the background
+        resized_img.paste(resized, (paste_x, paste_y))
+    
+    else:  # "fit" is the default
+        # Calculate new dimensions maintaining aspect ratio
+        if target_width and not target_height:
+            target_height = int(target_width / original_ratio)
+        elif target_height and not target_width:
+            target_width = int(target_height * original_ratio)
+        # If both dimensions are provided, fit within while maintaining ratio
+        elif target_width and target_height:
+            new_ratio = target_width / target_height
+    
+            if original_ratio > new_ratio:  # Image is wider than target
+                target_height = int(target_width / original_ratio)
+            else:  # Image is taller than target
+                target_width = int(target_height * original_ratio)
+    
+        # Perform the resize
+        resized_img = img.resize((target_width, target_height), Image.LANCZOS)
+    
+    # Save the result to a bytes buffer
+    buffered = io.BytesIO()
+    resized_img.save(buffered, format=output_format)
+    resized_data = buffered.getvalue()
+    
+    # Prepare metadata
+    metadata = {
+        "original_format": original_format,
+        "original_dimensions": original_size,
+        "resized_dimensions": (resized_img.width, resized_img.height),
+        "device": device if device else None,
+        "output_format": output_format,
+        "file_size_bytes": len(resized_data),
+        "fit_method": fit_method,
+        "aspect_ratio": "Maintain" if maintain_aspect_ratio else "Stretch"
+    }
+    
+    return resized_data, metadata
+
 async def resize_image(
-    image_data: bytes, 
+    image_data: Union[bytes, BinaryIO], 
     width: Optional[int] = None, 
     height: Optional[int] = None, 
     device: Optional[str] = None,
@@ -84,7 +298,8 @@ async def resize_image(
     Resize an image to specified dimensions or a predefined device format.
     
     Args:
-        image_data: Raw image data bytes
+        image_data: Raw image data bytes, or a binary file object (e.g. UploadFile.file)
+            which is decoded directly without reading it into memory first
         width: Desired width in pixels (overridden if device is specified)
         height: Desired height in pixels (overridden if device is specified)
         device: Device preset name (e.g., "iphone", "ipad", "desktop_hd")
@@ -106,147 +321,19 @@ async def resize_image(
         HTTPException: If image processing fails or invalid parameters
     """
     try:
-        # Load the image
-        img = Image.open(io.BytesIO(image_data))
-        original_format = img.format or "PNG"
-        original_size = (img.width, img.height)
-        original_ratio = original_size[0] / original_size[1]
-        
-        # Determine target dimensions
-        target_width, target_height = width, height
-        
-        # Use device preset if specified
-        if device:
-            device = device.lower()
-            if device in DEVICE_RESOLUTIONS:
-                target_width, target_height = DEVICE_RESOLUTIONS[device]
-            else:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Unknown device '{device}'. Available devices: {', '.join(DEVICE_RESOLUTIONS.keys())}"
-                )
-        
-        # Validate dimensions
-        if not (target_width or target_height):
-            raise HTTPException(
-                status_code=400, 
-                detail="Either width, height, or device must be specified"
-            )
-            
-        # Handle different fit methods
-        if fit_method == "stretch" or not maintain_aspect_ratio:
-            # Just force the dimensions, potentially distorting the image
-            if not target_width:
-                target_width = int(target_height * original_ratio)
-            if not target_height:
-                target_height = int(target_width / original_ratio)
-                
-            resized_img = img.resize((target_width, target_height), Image.LANCZOS)
-            
-        elif fit_method == "fill":
-            # Scale and crop to fill the target dimensions
-            if not target_width:
-                target_width = int(target_height * original_ratio)
-            if not target_height:
-                target_height = int(target_width / original_ratio)
-                
-            # Calculate dimensions that maintain aspect ratio while filling the target area
-            target_ratio = target_width / target_height
-            
-            if original_ratio > target_ratio:  # Image is wider than target
-                # Scale to match height, then crop width
-                scale_factor = target_height / original_size[1]
-                new_width = int(original_size[0] * scale_factor)
-                new_height = target_height
-                
-                # Resize to new dimensions
-                temp_img = img.resize((new_width, new_height), Image.LANCZOS)
-                
-                # Calculate crop box
-                left_crop = (new_width - target_width) // 2
-                resized_img = temp_img.crop((left_crop, 0, left_crop + target_width, target_height))
-                
-            else:  # Image is taller than target
-                # Scale to match width, then crop height
-                scale_factor = target_width / original_size[0]
-                new_width = target_width
-                new_height = int(original_size[1] * scale_factor)
-                
-                # Resize to new dimensions
-                temp_img = img.resize((new_width, new_height), Image.LANCZOS)
-                
-                # Calculate crop box
-                top_crop = (new_height - target_height) // 2
-                resized_img = temp_img.crop((0, top_crop, target_width, top_crop + target_height))
-        
-        elif fit_method == "pad":
-            # Ensure entire image is visible within target dimensions by adding padding
-            if not target_width:
-                target_width = int(target_height * original_ratio)
-            if not target_height:
-                target_height = int(target_width / original_ratio)
-                
-            # Calculate the scaling factor to fit within the target dimensions
-            target_ratio = target_width / target_height
-            
-            if original_ratio > target_ratio:  # Image is wider than target
-                # Scale by width
-                new_width = target_width
-                new_height = int(new_width / original_ratio)
-            else:  # Image is taller than target
-                # Scale by height
-                new_height = target_height
-                new_width = int(new_height * original_ratio)
-            
-            # Resize the image to fit within target dimensions
-            resized = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            # Create a new image with the target dimensions and the specified background color
-            resized_img = Image.new("RGB", (target_width, target_height), background_color)
-            
-            # Calculate position to paste (center the image)
-            paste_x = (target_width - new_width) // 2
-            paste_y = (target_height - new_height) // 2
-            
-            # Paste the resized image onto the background
-            resized_img.paste(resized, (paste_x, paste_y))
-                
-        else:  # "fit" is the default
-            # Calculate new dimensions maintaining aspect ratio
-            if target_width and not target_height:
-                target_height = int(target_width / original_ratio)
-            elif target_height and not target_width:
-                target_width = int(target_height * original_ratio)
-            # If both dimensions are provided, fit within while maintaining ratio
-            elif target_width and target_height:
-                new_ratio = target_width / target_height
-                
-                if original_ratio > new_ratio:  # Image is wider than target
-                    target_height = int(target_width / original_ratio)
-                else:  # Image is taller than target
-                    target_width = int(target_height * original_ratio)
-            
-            # Perform the resize
-            resized_img = img.resize((target_width, target_height), Image.LANCZOS)
-        
-        # Save the result to a bytes buffer
-        buffered = io.BytesIO()
-        resized_img.save(buffered, format=output_format)
-        resized_data = buffered.getvalue()
-        
-        # Prepare metadata
-        metadata = {
-            "original_format": original_format,
-            "original_dimensions": original_size,
-            "resized_dimensions": (resized_img.width, resized_img.height),
-            "device": device if device else None,
-            "output_format": output_format,
-            "file_size_bytes": len(resized_data),
-            "fit_method": fit_method,
-            "aspect_ratio": "Maintain" if maintain_aspect_ratio else "Stretch"
-        }
-        
-        return resized_data, metadata
+        # Decode, resample and encode in a worker thread, off the event loop
+        return await asyncio.to_thread(
+            _resize_image,
+            image_data,
+            width,
+            height,
+            device,
+            maintain_aspect_ratio,
+            fit_method,
+            output_format,
+            background_color,
+        )
         
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Image resize failed: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=f"Image resize failed: {str(e)}")
+ 
\ No newline at end of file
@@ -3,15 +3,120 @@ Shared storage for job tracking.
 
 This module provides a centralized storage for job data.
 In a production environment, this would be replaced by a database.
+
+Recently used jobs live in a bounded in-memory LRU. Changes are appended
+to a write-ahead log as JSON lines, so an update costs an append rather
+than a rewrite of the job's file. Intermediate updates to a job are
+coalesced and logged by a background task every JOBS_WAL_FLUSH_INTERVAL;
+new jobs and terminal status changes are logged immediately. At startup
+the log is replayed and compacted into one JSON file per job; jobs evicted
+from memory are written to their file too, which get_job falls back to.
 """
 
 import os
-import json
+import asyncio
+import threading
+import orjson
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, BinaryIO
+
+JOBS_DIR = "jobs"
+JOBS_WAL_PATH = f"{JOBS_DIR}/jobs.wal"
+# How often coalesced updates are logged and flushed to the OS, in seconds
+JOBS_WAL_FLUSH_INTERVAL = 0.25
+# Statuses whose updates are logged without waiting for the next flush
+TERMINAL_STATUSES = frozenset({"completed", "failed"})
+
+# Maximum number of jobs kept in memory
+MAX_JOBS = 10_000
+
+# Global jobs dictionary, in least to most recently used order
+jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+# Guards jobs and the log, since jobs may be updated from worker threads
+_lock = threading.Lock()
+
+# Append-only change log, opened by load_jobs
+_wal: Optional[BinaryIO] = None
+# Updates not yet logged, merged per job
+_pending: Dict[str, Dict[str, Any]] = {}
+
+def _append_record(record: Dict[str, Any]) -> None:
+    """Append a change record to the job log."""
+    if _wal is not None:
+        _wal.write(orjson.dumps(record) + b"\n")
+
+def _load_job_file(job_id: str) -> Optional[Dict[str, Any]]:
+    """Read a job's compacted JSON file, if there is one."""
+    job_path = f"{JOBS_DIR}/{job_id}.json"
+    if os.path.exists(job_path):
+        with open(job_path, "rb") as f:
+            return orjson.loads(f.read())
+    return None
+
+def _write_job_file(job_id: str, job_data: Dict[str, Any]) -> None:
+    """Write a job's full state to its JSON file."""
+    with open(f"{JOBS_DIR}/{job_id}.json", "wb") as f:
+        f.write(orjson.dumps(job_data))
+
+def _cache_job(job_id: str, job_data: Dict[str, Any]) -> None:
+    """
+    Store a job as the most recently used, evicting the least recently used jobs
+    to disk beyond MAX_JOBS. Must be called with _lock held.
+    """
+    jobs[job_id] = job_data
+    jobs.move_to_end(job_id)
+    while len(jobs) > MAX_JOBS:
+        evicted_id, evicted = jobs.popitem(last=False)
+        _write_job_file(evicted_id, evicted)
 
-# Global jobs dictionary
-jobs: Dict[str, Dict[str, Any]] = {}
+def load_jobs() -> None:
+    """
+    Replay the job log into per-job files, then start a fresh log.
+    Called once at startup.
+    """
+    global _wal
+    replayed: Dict[str, Dict[str, Any]] = {}
+    if os.path.exists(JOBS_WAL_PATH):
+        with open(JOBS_WAL_PATH, "rb") as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # A torn final line from a crash mid-append
+                    continue
+                job_id = record["id"]
+                if job_id not in replayed:
+                    replayed[job_id] = _load_job_file(job_id) or {}
+                replayed[job_id].update(record)
+    
+    # Compact: write each replayed job's final state, then truncate the log
+    for job_id, job_data in replayed.items():
+        _write_job_file(job_id, job_data)
+    _wal = open(JOBS_WAL_PATH, "wb", buffering=1024 * 1024)
+
+def flush_jobs() -> None:
+    """Log coalesced updates and flush buffered log records to the OS."""
+    with _lock:
+        for record in _pending.values():
+            _append_record(record)
+        _pending.clear()
+        if _wal is not None:
+            _wal.flush()
+
+async def run_jobs_flusher() -> None:
+    """Flush the job log every JOBS_WAL_FLUSH_INTERVAL seconds until cancelled."""
+    while True:
+        await asyncio.sleep(JOBS_WAL_FLUSH_INTERVAL)
+        flush_jobs()
+
+def close_jobs() -> None:
+    """Flush and close the job log. Called once at shutdown."""
+    global _wal
+    flush_jobs()
+    if _wal is not None:
+        _wal.close()
+        _wal = None
 
 def get_job(job_id: str) -> Optional[Dict[str, Any]]:
     """
@@ -24,17 +129,21 @@ def get_job(job_id: str) -> Optional[Dict[str, Any]]:
         The job data as a dictionary, or None if not found
     """
     # First check in-memory jobs dictionary
-    if job_id in jobs:
-        return jobs[job_id]
+    with _lock:
+        job_data = jobs.get(job_id)
+        if job_data is not None:
+            jobs.move_to_end(job_id)
+            return job_data
     
     # If not in memory, try to load from file
-    job_path = f"jobs/{job_id}.json"
-    if os.path.exists(job_path):
-        with open(job_path, "r") as f:
-            job_data = json.load(f)
-            # Cache back in memory
-            jobs[job_id] = job_data
-            return job_data
+    job_data = _load_job_file(job_id)
+    if job_data is not None:
+        with _lock:
+            # Cache back in memory, unless another caller got there first
+            if job_id in jobs:
+                return jobs[job_id]
+            _cache_job(job_id, job_data)
+        return job_data
     
     # Job not found
     return None
@@ -62,12 +171,10 @@ def create_job(job_id: str, job_type: str, text: str, images: list = None) -> Di
         "images": [img["filename"] for img in images] if images else []
     }
     
-    # Store in memory
-    jobs[job_id] = job_data
-    
-    # Save to file
-    with open(f"jobs/{job_id}.json", "w") as f:
-        json.dump(job_data, f)
+    # Store in memory and log it
+    with _lock:
+        _cache_job(job_id, job_data)
+        _append_record(job_data)
     
     return job_data
 
@@ -82,18 +189,27 @@ def update_job(job_id: str, updates: Dict[str, Any]) -> Optional[Dict[str, Any]]
     Returns:
         The updated job data, or None if job not found
     """
-    job = get_job(job_id)
-    if not job:
-        return None
+    # Live jobs are almost always in memory; only fall back to disk on a miss
+    job = jobs.get(job_id)
+    if job is None:
+        job = get_job(job_id)
+        if not job:
+            return None
     
-    # Update job fields
-    job.update(updates)
-    job["updated_at"] = datetime.now().isoformat()
-    
-    # Save back to memory and file
-    jobs[job_id] = job
-    with open(f"jobs/{job_id}.json", "w") as f:
-        json.dump(job, f)
+    with _lock:
+        # Update job fields
+        job.update(updates)
+        job["updated_at"] = datetime.now().isoformat()
+        
+        # Save back to memory and queue only the changed fields for the log
+        _cache_job(job_id, job)
+        record = _pending.setdefault(job_id, {"id": job_id})
+        record.update(updates)
+        record["updated_at"] = job["updated_at"]
+        
+        # Terminal updates are logged right away rather than on the next flush
+        if job.get("status") in TERMINAL_STATUSES:
+            _append_record(_pending.pop(job_id))
     
     return job
 
@@ -105,8 +221,8 @@ def set_job_failed(job_id: str, error: str) -> None:
         job_id: ID of the job to mark as failed
         error: Error message describing the failure
     """
-    if job_id in jobs:
-        update_job(job_id, {
-            "status": "failed",
-            "error": error
-        }) 
\ No newline at end of file
+    # update_job ignores unknown jobs and loads evicted ones from disk
+    update_job(job_id, {
+        "status": "failed",
+        "error": error
+    }) 
\ No newline at end of file
@@ -2,37 +2,77 @@
 Utility functions for LoRA detection and handling.
 """
 
-from typing import Dict, Any
+import re
+from typing import Dict, Any, List, Optional, Pattern, Set, Tuple
 from ..logging import logger, StatusMarker
 from ..models_lib import models_lib
 
+def _build_trigger_matcher(loras: Dict[str, Dict[str, Any]]) -> Tuple[Optional[Pattern[str]], Dict[str, Tuple[str, ...]]]:
+    """
+    Compile every LoRA trigger word into one pattern that finds them all in a single scan.
+
+    The pattern is a lookahead, so it tests every position of the prompt and overlapping
+    triggers are all seen. Alternatives are ordered longest first, so each position yields
+    the longest trigger starting there; any shorter trigger matching at the same position
+    is a prefix of it, so each trigger maps to the LoRAs of all its prefix triggers too.
+
+    Returns:
+        The compiled pattern (None if there are no triggers), and the names of the
+        LoRAs to select for each matched trigger
+    """
+    names_by_trigger: Dict[str, List[str]] = {}
+    for lora_name, lora_info in loras.items():
+        for trigger_word in lora_info.get("trigger_words", []):
+            names_by_trigger.setdefault(trigger_word.lower(), []).append(lora_name)
+
+    if not names_by_trigger:
+        return None, {}
+
+    triggers = sorted(names_by_trigger, key=len, reverse=True)
+    names_by_match = {
+        trigger: tuple(dict.fromkeys(
+            lora_name
+            for prefix in triggers if trigger.startswith(prefix)
+            for lora_name in names_by_trigger[prefix]
+        ))
+        for trigger in triggers
+    }
+    pattern = re.compile("(?=(" + "|".join(map(re.escape, triggers)) + "))")
+    return pattern, names_by_match
+
+# models_lib is static, so the matcher is built once at import
+_TRIGGER_PATTERN, _LORA_NAMES_BY_TRIGGER = _build_trigger_matcher(models_lib.get("loras", {}))
+
 def identify_loras_in_prompt(prompt: str) -> Dict[str, Dict[str, Any]]:
     """
     Analyze a prompt to identify potential LoRAs to use in image generation.
-    
+
     Args:
         prompt: The text prompt to analyze
-        
+
     Returns:
         Dictionary of LoRA configurations to pass to the API
     """
     loras = {}
-    
+
     # Get all available loras from models_lib
     available_loras = models_lib.get("loras", {})
-    
-    # Look for trigger words in the prompt
+
+    # Find every trigger word in the prompt in one pass
+    matched: Set[str] = set()
+    if _TRIGGER_PATTERN is not None:
+        for match in _TRIGGER_PATTERN.finditer(prompt.lower()):
+            matched.update(_LORA_NAMES_BY_TRIGGER[match.group(1)])
+
+    # Keep models_lib order for the selected LoRAs
     for lora_name, lora_info in available_loras.items():
-        trigger_words = lora_info.get("trigger_words", [])
-        
-        # Check if any trigger words are in the prompt
-        if any(trigger_word.lower() in prompt.lower() for trigger_word in trigger_words):
+        if lora_name in matched:
             # Add this LoRA to the dictionary
             lora_urn = lora_info["air"]
             loras[lora_urn] = {
                 "type": "Lora",
                 "strength": 0.75  # Default strength
             }
-            logger.info(f"{StatusMarker.LORA} Found LoRA '{lora_name}' in prompt based on trigger words: {trigger_words}")
-    
-    return loras 
\ No newline at end of file
+            logger.info(f"{StatusMarker.LORA} Found LoRA '{lora_name}' in prompt based on trigger words: {lora_info.get('trigger_words', [])}")
+
+    return loras
@@ -0,0 +1,144 @@
+"""
+Helpers for writing generated images to the output directory.
+
+Encoding is CPU-bound and runs in a worker thread; the encoded bytes are
+then written with aiofiles so the event loop never blocks on disk I/O.
+Files are written under a temporary name and renamed into place, so a
+reader never sees a partially written image. Outputs are cache-like, so
+there is deliberately no fsync; the OS is free to batch the writeback.
+The output directories are created once at application startup.
+"""
+
+import io
+import os
+import asyncio
+import secrets
+import itertools
+import aiofiles
+import aiofiles.os
+from PIL import Image
+from typing import AsyncIterable, Set
+
+OUTPUT_DIR = "output"
+OUTPUT_TMP_DIR = f"{OUTPUT_DIR}/.tmp"
+
+# Output filenames are a per-process random salt, the pid and a counter: unique without
+# reading /dev/urandom per file. The salt keeps names unique across restarts, since
+# files persist in the output directory.
+_filename_salt = secrets.token_hex(4)
+_filename_pid = os.getpid()
+_filename_counter = itertools.count()
+
+def _reset_filename_state() -> None:
+    global _filename_salt, _filename_pid, _filename_counter
+    _filename_salt = secrets.token_hex(4)
+    _filename_pid = os.getpid()
+    _filename_counter = itertools.count()
+
+# Forked workers must not reuse the parent's sequence
+os.register_at_fork(after_in_child=_reset_filename_state)
+
+def new_output_filename(prefix: str, extension: str) -> str:
+    """Return a unique filename such as "remix_1a2b3c4d7f_0.webp"."""
+    return f"{prefix}_{_filename_salt}{_filename_pid:x}_{next(_filename_counter)}.{extension}"
+
+# Names of files known to exist in the output directory, so lookups usually need no syscall
+_output_files: Set[str] = set()
+
+def load_output_index() -> None:
+    """Populate the output file index from disk. Called once at startup."""
+    _output_files.update(name for name in os.listdir(OUTPUT_DIR) if not name.startswith("."))
+
+def register_output(filename: str) -> None:
+    """Record a file that has been completely written to the output directory."""
+    _output_files.add(filename)
+
+async def output_exists(filename: str) -> bool:
+    """
+    Check whether a file exists in the output directory.
+
+    Known files are answered from memory. Unknown names fall back to a stat,
+    which covers files written by another worker process. Every writer goes
+    through write_output or write_output_stream, so a file present in the
+    output directory is always complete.
+    """
+    if filename in _output_files:
+        return True
+    if filename.startswith(".") or "/" in filename:
+        return False
+    if await aiofiles.os.path.isfile(f"{OUTPUT_DIR}/{filename}"):
+        _output_files.add(filename)
+        return True
+    return False
+
+def encode_image(image: Image.Image, format: str, **params) -> bytes:
+    """
+    Encode an image into memory.
+
+    Args:
+        image: The image to encode
+        format: PIL format name (e.g. "WEBP", "PNG", "JPEG")
+        **params: Extra encoder options passed to Image.save
+
+    Returns:
+        The encoded image bytes
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **params)
+    return buffer.getvalue()
+
+async def write_output_stream(filename: str, chunks: AsyncIterable[bytes]) -> str:
+    """
+    Stream data into a temporary file, then atomically move it into the output
+    directory. The file is only registered once it is complete; on any error
+    the temporary file is removed and nothing appears in the output directory.
+
+    Args:
+        filename: Name of the file inside the output directory
+        chunks: The file contents, e.g. a download's aiter_bytes()
+
+    Returns:
+        The path of the written file
+    """
+    file_path = f"{OUTPUT_DIR}/{filename}"
+    tmp_path = f"{OUTPUT_TMP_DIR}/{filename}.part"
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            async for chunk in chunks:
+                await f.write(chunk)
+        await aiofiles.os.replace(tmp_path, file_path)
+        register_output(filename)
+    except BaseException:
+        # Don't leave partial files behind
+        try:
+            await aiofiles.os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return file_path
+
+async def write_output(filename: str, data: bytes) -> str:
+    """
+    Write encoded image bytes to the output directory in a single write,
+    then atomically move the file into place.
+
+    Args:
+        filename: Name of the file inside the output directory
+        data: The encoded file contents
+
+    Returns:
+        The path of the written file
+    """
+    async def single_chunk():
+        yield data
+    return await write_output_stream(filename, single_chunk())
+
+async def save_output_image(image: Image.Image, filename: str, format: str, **params) -> str:
+    """
+    Encode an image in a worker thread and write it to the output directory.
+
+    Returns:
+        The path of the written file
+    """
+    data = await asyncio.to_thread(encode_image, image, format, **params)
+    return await write_output(filename, data)
@@ -0,0 +1,124 @@
+"""
+Cache of decoded source images.
+
+Remix sources are usually the same URL across a session, and upscale reopens
+files from the output directory, which never change once written. Decoded
+images are kept in a size-bounded LRU so repeat requests skip the download
+and the decode. Cached images are shared: callers must not modify them in
+place (PIL enhancers, filters and resizes all return new images).
+"""
+
+import io
+import asyncio
+import aiofiles
+import httpx
+from typing import Optional, Union
+from fastapi import HTTPException
+from PIL import Image
+from cachetools import LRUCache
+
+from .output_storage import OUTPUT_DIR
+
+# Bound the cache by decoded pixel bytes rather than entry count
+SOURCE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def _image_nbytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+_source_cache: LRUCache = LRUCache(maxsize=SOURCE_CACHE_MAX_BYTES, getsizeof=_image_nbytes)
+
+# Largest source image download accepted, in encoded bytes
+MAX_SOURCE_BYTES = 50 * 1024 * 1024
+# Most buffer preallocated from a Content-Length header; larger bodies grow the buffer as they stream
+_MAX_PREALLOCATE_BYTES = 8 * 1024 * 1024
+
+def _declared_length(response: httpx.Response) -> int:
+    """Return the response's Content-Length, or 0 when absent. Rejects malformed or oversized values."""
+    value = response.headers.get("content-length")
+    if value is None:
+        return 0
+    try:
+        length = int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Source image server sent an invalid Content-Length")
+    if length < 0:
+        raise HTTPException(status_code=400, detail="Source image server sent an invalid Content-Length")
+    if length > MAX_SOURCE_BYTES:
+        raise HTTPException(status_code=413, detail=f"Source image exceeds {MAX_SOURCE_BYTES} bytes")
+    return length
+
+def _decode(data: Union[bytes, bytearray], mode: Optional[str] = None) -> Image.Image:
+    image = Image.open(io.BytesIO(data))
+    if mode and image.mode != mode:
+        image = image.convert(mode)
+    image.load()
+    return image
+
+def _cache_put(key: str, image: Image.Image) -> None:
+    # Images larger than the whole cache are simply not cached
+    if _image_nbytes(image) <= SOURCE_CACHE_MAX_BYTES:
+        _source_cache[key] = image
+
+async def fetch_source_image(client: httpx.AsyncClient, url: str, mode: str = "RGB") -> Image.Image:
+    """
+    Download and decode an image, reusing a cached copy when available.
+
+    Args:
+        client: Shared HTTP client
+        url: URL of the image
+        mode: PIL mode to convert the image to
+
+    Returns:
+        The decoded image
+
+    Raises:
+        httpx.HTTPError: If the download fails
+        HTTPException: 413 if the image is larger than MAX_SOURCE_BYTES,
+            400 if the server sends an invalid Content-Length
+    """
+    key = f"{mode}:{url}"
+    image = _source_cache.get(key)
+    if image is not None:
+        return image
+
+    # Stream the body into a single buffer, sized up front (within a cap) when the length is known.
+    # The URL is user-supplied, so neither the header nor the body is trusted to be small.
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        buffer = bytearray(min(_declared_length(response), _MAX_PREALLOCATE_BYTES))
+        size = 0
+        async for chunk in response.aiter_bytes(65536):
+            if size + len(chunk) > MAX_SOURCE_BYTES:
+                raise HTTPException(status_code=413, detail=f"Source image exceeds {MAX_SOURCE_BYTES} bytes")
+            # Slice assignment writes in place, and grows the buffer if the body is longer
+            buffer[size:size + len(chunk)] = chunk
+            size += len(chunk)
+        del buffer[size:]
+    
+    image = await asyncio.to_thread(_decode, buffer, mode)
+    _cache_put(key, image)
+    return image
+
+async def load_output_image(filename: str) -> Image.Image:
+    """
+    Read and decode an image from the output directory, reusing a cached copy when available.
+
+    Args:
+        filename: Name of the file inside the output directory
+
+    Returns:
+        The decoded image, in its original mode
+
+    Raises:
+        FileNotFoundError: If the file does not exist
+    """
+    key = f"file:{filename}"
+    image = _source_cache.get(key)
+    if image is not None:
+        return image
+
+    async with aiofiles.open(f"{OUTPUT_DIR}/{filename}", "rb") as f:
+        data = await f.read()
+    image = await asyncio.to_thread(_decode, data)
+    _cache_put(key, image)
+    return image